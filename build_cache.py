@@ -0,0 +1,67 @@
+"""
+Decodes, resizes, and packs a dataset into its memory-mapped sample cache
+ahead of training, e.g.
+
+    python -m build_cache --dataset ConvLSTMCDataset \
+        --data-manifest sits_manifest.json --cache-path ../sits_cache.bin
+
+Training then reads the pre-decoded uint8 samples by passing the same
+`--cache-path` (and dataset arguments) to `train.py`.
+"""
+
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import argparse
+import logging
+import os
+import time
+
+from datasets import (ConvLSTMCDataset, EurosatDataset,
+                      XYZObjectDetectionDataset, XYZObjectDetectionDatasetTwo,
+                      XYZTileDataset)
+from script_utils import get_args
+
+SCRIPT_PATH = os.path.basename(__file__)
+
+DEFAULT_DATASET_NAME = ConvLSTMCDataset.__name__
+
+DATASETS = {
+    EurosatDataset.__name__: EurosatDataset,
+    ConvLSTMCDataset.__name__: ConvLSTMCDataset,
+    XYZTileDataset.__name__: XYZTileDataset,
+    XYZObjectDetectionDataset.__name__: XYZObjectDetectionDataset,
+    XYZObjectDetectionDatasetTwo.__name__: XYZObjectDetectionDatasetTwo
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset",
+        default=DEFAULT_DATASET_NAME
+    )
+    parser.add_argument(
+        "--cache-path",
+        required=True
+    )
+    p_args, _ = parser.parse_known_args()
+    return p_args
+
+
+def main():
+    args = get_args(script_path=SCRIPT_PATH, **vars(parse_args()))
+    dataset_name: str = args["dataset"]
+
+    start = time.time()
+    # The dataset builds its cache from `--cache-path` if it doesn't exist yet
+    dataset = DATASETS[dataset_name]()
+    logging.info(
+        f"Cache {args['cache_path']} holds {len(dataset)} samples of "
+        f"{dataset_name} with shape {dataset.cache.shape[1:]} "
+        f"({time.time() - start:.1f}s)."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,24 +2,517 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
 import argparse
-import glob
+import collections
+import functools
 import json
 import math
 import os
-import random
-from typing import List, Tuple, Optional
+import pickle
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, List, Tuple, Optional
 
 import numpy as np
 import torch
+import torch.nn as nn
 import torchvision.transforms as T
-import torchvision.transforms.functional as TF
 from osgeo import gdal
 from PIL import Image
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+from torchvision.io import ImageReadMode, read_image
 
 from script_utils import arg_is_true, parse_args
+from transforms import BatchAugmentation
 from prepare_sios import prepare_sios_samples, get_negative_sios_samples
 
+os.environ.setdefault("GDAL_CACHEMAX", "512") # MB
+gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO") # Don't look for .aux.xml sidecars
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR") # Don't list the tile's directory
+gdal.UseExceptions()
+
+
+def scan_files(root: str, suffixes: Tuple[str, ...]):
+    """
+    Recursively yields the paths of files under `root` whose names end with
+    one of `suffixes`. Uses `os.scandir`, whose entries already know their
+    type, so no extra stat or fnmatch is needed per entry.
+    """
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_files(entry.path, suffixes)
+            elif entry.name.endswith(suffixes):
+                yield entry.path
+
+
+def walk_leaf_dirs(root: str) -> Generator[Tuple[str, List[str]], None, None]:
+    """
+    Yields `(dirpath, filenames)` for every directory under `root` that has
+    no subdirectories, in the same order as `os.walk`. Uses `os.scandir`
+    directly and skips the bookkeeping `os.walk` does for non-leaf
+    directories. As with `os.walk`, symlinked directories are not followed.
+    """
+    has_subdirs: bool = False
+    dirpaths: List[str] = list()
+    filenames: List[str] = list()
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir():
+                has_subdirs = True
+                if not entry.is_symlink():
+                    dirpaths.append(entry.path)
+            else:
+                filenames.append(entry.name)
+    if not has_subdirs:
+        yield root, filenames
+    for dirpath in dirpaths:
+        yield from walk_leaf_dirs(dirpath)
+
+
+def get_leaf_dirs(
+    root: str, cache_path: Optional[str] = None
+) -> List[Tuple[str, List[str]]]:
+    """
+    Returns `list(walk_leaf_dirs(root))`. If `cache_path` is given the result
+    is pickled there and reused while `root` and its modification time are
+    unchanged. Note that the modification time of `root` only reflects
+    changes to its direct entries; delete the cache after editing the tree.
+    """
+    if cache_path is None:
+        return list(walk_leaf_dirs(root))
+    key: tuple = (os.path.abspath(root), os.stat(root).st_mtime_ns)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cached: dict = pickle.load(f)
+        if cached["key"] == key:
+            return cached["leaf_dirs"]
+    leaf_dirs: List[Tuple[str, List[str]]] = list(walk_leaf_dirs(root))
+    with open(cache_path, "wb") as f:
+        pickle.dump({"key": key, "leaf_dirs": leaf_dirs}, f)
+    return leaf_dirs
+
+
+@functools.lru_cache(maxsize=None)
+def _load_json(path: str, mtime_ns: int) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_json(path: str) -> dict:
+    """
+    Parses a manifest or annotations file once per process; constructing
+    several datasets from the same (unmodified) file reuses the result, which
+    is shared and so must not be mutated.
+    """
+    path = os.path.abspath(path)
+    return _load_json(path, os.stat(path).st_mtime_ns)
+
+
+def join_path(dirpath: str, filename: str) -> str:
+    return os.path.join(dirpath, filename).replace("\\", "/")
+
+
+def compile_key_matcher(keys) -> re.Pattern:
+    """
+    Compiles `keys` into a single regex so that finding which key occurs in a
+    path is one scan instead of one substring test per key. Longer keys are
+    tried first so that a key which is a prefix of another never shadows it.
+    """
+    keys = sorted(keys, key=len, reverse=True)
+    if not keys:
+        return re.compile(r"(?!)") # Never matches
+    return re.compile("|".join(re.escape(key) for key in keys))
+
+
+def validate_paths(filepaths: List[str]) -> None:
+    missing: List[str] = [
+        filepath for filepath in filepaths if not os.path.exists(filepath)
+    ]
+    if missing:
+        raise FileNotFoundError(
+            f"{len(missing)} of {len(filepaths)} files do not exist, e.g. {missing[0]}."
+        )
+
+
+def read_image_rgb(filepath: str) -> torch.Tensor:
+    """
+    Decodes `filepath` to a `C x H x W` uint8 RGB tensor with torchvision.io
+    (libpng / libjpeg), falling back to PIL for formats torchvision cannot
+    decode.
+    """
+    try:
+        return read_image(filepath, mode=ImageReadMode.RGB)
+    except RuntimeError:
+        arr: np.ndarray = np.asarray(Image.open(filepath).convert('RGB')) # H x W x C
+        return torch.from_numpy(arr.copy()).permute(2, 0, 1).contiguous()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_thread_pool(num_threads: int, pid: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=num_threads)
+
+
+def get_thread_pool(num_threads: int) -> ThreadPoolExecutor:
+    """
+    Returns this process's shared pool of `num_threads` threads. Keyed by pid
+    too, since a pool inherited through fork has no live threads.
+    """
+    return _get_thread_pool(num_threads, os.getpid())
+
+
+def build_memmap_cache(
+    cache_path: str, load_fn: Callable, num_samples: int,
+    meta: Optional[Dict[str, np.ndarray]] = None
+) -> None:
+    """
+    Loads every sample once using `load_fn(idx)` and writes them, in index
+    order, to a single memory-mapped array at `cache_path`. Per-sample `meta`
+    arrays (labels, sample ids, ...) are saved to `<cache_path>.npz` and the
+    array's dtype and shape to `<cache_path>.json`. The header is written last,
+    so an interrupted build is never mistaken for a complete cache.
+    """
+    if meta is None:
+        meta = dict()
+    first: np.ndarray = np.asarray(load_fn(0))
+    shape: tuple = (num_samples, *first.shape)
+    cache = np.memmap(cache_path, mode="w+", dtype=first.dtype, shape=shape)
+    cache[0] = first
+    for idx in range(1, num_samples):
+        cache[idx] = np.asarray(load_fn(idx))
+    cache.flush()
+    del cache
+    np.savez(cache_path + ".npz", **meta)
+    header: dict = {"dtype": first.dtype.str, "shape": list(shape)}
+    with open(cache_path + ".json", "w") as f:
+        json.dump(header, f)
+
+
+def open_memmap_cache(cache_path: str) -> Tuple[np.memmap, Dict[str, np.ndarray]]:
+    with open(cache_path + ".json") as f:
+        header: dict = json.load(f)
+    # Copy-on-write: pages are shared through the OS page cache (and across
+    # DataLoader workers) but the file itself is never modified.
+    cache = np.memmap(
+        cache_path, mode="c", dtype=np.dtype(header["dtype"]),
+        shape=tuple(header["shape"])
+    )
+    with np.load(cache_path + ".npz") as f:
+        meta: Dict[str, np.ndarray] = {key: f[key] for key in f.files}
+    return cache, meta
+
+
+def get_memmap_cache(
+    cache_path: str, load_fn: Callable, sample_ids: List[str],
+    meta: Optional[Dict[str, np.ndarray]] = None,
+    image_size: Optional[Tuple[int, int]] = None
+) -> Tuple[np.memmap, Dict[str, np.ndarray]]:
+    """
+    Opens the cache at `cache_path`, building it first if it does not exist.
+    `sample_ids` identifies each sample in index order and is used to check
+    that an existing cache was built from the same samples. If `image_size`
+    is given, the cached samples' trailing `(H, W)` must match it.
+    """
+    if not os.path.exists(cache_path + ".json"):
+        if meta is None:
+            meta = dict()
+        meta["sample_ids"] = np.asarray(sample_ids)
+        build_memmap_cache(
+            cache_path=cache_path, load_fn=load_fn, num_samples=len(sample_ids),
+            meta=meta
+        )
+    cache, meta = open_memmap_cache(cache_path)
+    if not np.array_equal(meta["sample_ids"], np.asarray(sample_ids)):
+        raise ValueError(
+            f"Cache {cache_path} was built from a different set of samples. "
+            "Delete it (and its .json and .npz files) to rebuild it."
+        )
+    if image_size is not None and tuple(cache.shape[-2:]) != tuple(image_size):
+        raise ValueError(
+            f"Cache {cache_path} holds {tuple(cache.shape[-2:])} images but "
+            f"{tuple(image_size)} images were requested. Use a cache path per "
+            "input size or delete the cache to rebuild it."
+        )
+    return cache, meta
+
+
+class SampleCache:
+    """
+    Bounded in-memory cache of decoded samples, so that files are decoded
+    once rather than every epoch. Samples are added until the budget is
+    reached and are never evicted. Each process holds its own cache (it is
+    emptied when pickled), so `max_bytes` is split evenly across DataLoader
+    worker processes, keeping the total at `max_bytes`; the main-process and
+    `ThreadPoolLoader` loaders, whose threads share one cache, get all of it.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.budget: Optional[int] = None # Resolved in the process that fills it
+        self.samples: dict = dict()
+        self.num_bytes: int = 0
+        self.lock = threading.Lock()
+
+
+    def get_budget(self) -> int:
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return self.max_bytes
+        return self.max_bytes // worker_info.num_workers
+
+
+    def get(self, idx: int, load_fn: Callable):
+        sample = self.samples.get(idx)
+        if sample is None:
+            sample = load_fn(idx)
+            with self.lock:
+                if self.budget is None:
+                    self.budget = self.get_budget()
+                if idx not in self.samples \
+                    and self.num_bytes + sample.nbytes <= self.budget:
+                    self.samples[idx] = sample
+                    self.num_bytes += sample.nbytes
+        return sample
+
+
+    def __getstate__(self) -> dict:
+        return {"max_bytes": self.max_bytes}
+
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["max_bytes"])
+
+
+def get_sample_cache(ram_cache_gb: float) -> Optional[SampleCache]:
+    if ram_cache_gb > 0:
+        return SampleCache(max_bytes=int(ram_cache_gb * 2 ** 30))
+    return None
+
+
+def make_box_target(
+    boxes: torch.Tensor, original_image_size: Optional[Tuple[int]] = None,
+    transformed_image_size: Optional[Tuple[int]] = None
+) -> dict:
+    """
+    Builds a torchvision detection target from an `N x 4` float32 tensor of
+    `(x_min, y_min, x_max, y_max)` boxes in original-image pixels, rescaling
+    them (into a new tensor) if both image sizes, given as `(W, H)`, are set.
+    """
+    if original_image_size is not None and transformed_image_size is not None:
+        original_image_width, original_image_height = original_image_size
+        transformed_image_width, transformed_image_height = transformed_image_size
+        width_ratio = transformed_image_width / original_image_width
+        height_ratio = transformed_image_height / original_image_height
+        boxes = boxes * torch.tensor(
+            [width_ratio, height_ratio, width_ratio, height_ratio], dtype=torch.float32
+        )
+
+    target = dict()
+    target["boxes"] = boxes
+    target["labels"] = torch.ones(len(boxes), dtype=torch.int64) # (N,) as torchvision expects
+    # target["image_id"] = [index]
+    # target["area"] = area
+    return target
+
+
+def map_batch(fn: Callable, batch):
+    """
+    Applies `fn` to every tensor of a (possibly nested) dict, list or tuple
+    batch, keeping its structure.
+    """
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, dict):
+        return {key: map_batch(fn, value) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(map_batch(fn, value) for value in batch)
+    return batch
+
+
+def pin_batch(batch):
+    return map_batch(lambda tensor: tensor.pin_memory(), batch)
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a loader so that the host-to-device copy of batch N + 1 is issued
+    on a side CUDA stream while batch N is being computed. Batches come out
+    with every tensor already on `device`; the loader should pin memory so
+    the copies are asynchronous.
+    """
+    def __init__(self, loader, device: torch.device):
+        self.loader = loader
+        self.device = device
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.loader)
+
+        def preload():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return map_batch(
+                    lambda tensor: tensor.to(self.device, non_blocking=True), batch
+                )
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # Memory allocated on the side stream is used on the current one
+            map_batch(lambda tensor: tensor.record_stream(current_stream), batch)
+            next_batch = preload()
+            yield batch
+
+
+class ThreadPoolLoader:
+    """
+    Drop-in replacement for `torch.utils.data.DataLoader` which loads samples
+    with a pool of threads in the main process rather than with worker
+    processes. Image decoding (torchvision.io, GDAL) and tensor ops release
+    the GIL, so threads parallelize well here. Batches never cross a process
+    boundary, and there is no worker start-up cost.
+    """
+    __name__ = "ThreadPoolLoader"
+
+    DEFAULT_PREFETCH_BATCHES: int = 2
+
+
+    def __init__(
+        self, dataset: Dataset, batch_size: Optional[int] = 1, 
+        shuffle: Optional[bool] = False, num_threads: Optional[int] = os.cpu_count(),
+        collate_fn: Optional[Callable] = None, pin_memory: Optional[bool] = False,
+        prefetch_batches: Optional[int] = DEFAULT_PREFETCH_BATCHES,
+        generator: Optional[torch.Generator] = None
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_threads = num_threads
+        if collate_fn is None:
+            collate_fn = default_collate
+        self.collate_fn = collate_fn
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.prefetch_batches = prefetch_batches
+        self.generator = generator
+
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
+    def __iter__(self):
+        num_samples: int = len(self.dataset)
+        if self.shuffle:
+            indices: List[int] = torch.randperm(
+                num_samples, generator=self.generator
+            ).tolist()
+        else:
+            indices: List[int] = list(range(num_samples))
+        batch_indices = (
+            indices[start:start + self.batch_size] \
+                for start in range(0, num_samples, self.batch_size)
+        )
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            pending = collections.deque()
+
+            def submit_next_batch() -> None:
+                idxs: Optional[List[int]] = next(batch_indices, None)
+                if idxs is not None:
+                    pending.append(
+                        [executor.submit(self.dataset.__getitem__, idx) for idx in idxs]
+                    )
+
+            for _ in range(self.prefetch_batches + 1):
+                submit_next_batch()
+            try:
+                while pending:
+                    futures: list = pending.popleft()
+                    submit_next_batch()
+                    batch = self.collate_fn([future.result() for future in futures])
+                    if self.pin_memory:
+                        batch = pin_batch(batch)
+                    yield batch
+            finally: # Don't load batches nobody will consume
+                for futures in pending:
+                    for future in futures:
+                        future.cancel()
+
+
+class StringArray:
+    """
+    Read-only list of strings packed into one uint8 tensor of UTF-8 bytes plus
+    an int64 tensor of offsets. Both tensors live in shared memory, so
+    DataLoader workers read one shared buffer instead of each holding its own
+    copy of a list of Python strings (which reference counting would touch,
+    and so copy, page by page under fork).
+    """
+    __name__ = "StringArray"
+
+
+    def __init__(self, strings: List[str]):
+        encoded: List[bytes] = [string.encode("utf-8") for string in strings]
+        offsets: np.ndarray = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        buffer: np.ndarray = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        self.buffer: torch.Tensor = torch.from_numpy(buffer.copy()).share_memory_()
+        self.offsets: torch.Tensor = torch.from_numpy(offsets).share_memory_()
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Index {idx} out of range for StringArray of length {len(self)}.")
+        start, end = self.offsets[idx:idx + 2].tolist()
+        return self.buffer[start:end].numpy().tobytes().decode("utf-8")
+
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+SCRIPT_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _script_float_transforms() -> torch.jit.ScriptModule:
+    return torch.jit.script(nn.Sequential(T.ConvertImageDtype(torch.float32)))
+
+
+def get_float_transforms() -> torch.jit.ScriptModule:
+    """
+    Returns the scripted uint8 -> float32 stage. It is built once per process
+    and shared by every dataset; ScriptModules cannot be pickled, so datasets
+    never hold it.
+    """
+    with SCRIPT_LOCK: # Several ThreadPoolLoader threads may ask at once
+        return _script_float_transforms()
+
+
+class ScriptedTransformsMixin:
+    """
+    Applies the shared, scripted float stage to uint8 images. Normalization
+    is left to the (detection) models, which normalize their own inputs.
+    """
+
+
+    def apply_transforms(self, image: torch.Tensor) -> torch.Tensor:
+        return get_float_transforms()(image)
+
 
 class EurosatDataset(Dataset):
     __name__ = "EurosatDataset"
@@ -27,25 +520,55 @@ class EurosatDataset(Dataset):
     DEFAULT_DATA_MANIFEST: str = "eurosat_manifest.json"
     DEFAULT_BANDS: List[int] = [1, 2, 3, 7]
     DEFAULT_USE_DATA_AUG: bool = True
+    DEFAULT_CACHE_PATH: Optional[str] = None
+    DEFAULT_VALIDATE_PATHS: bool = False
+    DEFAULT_RAM_CACHE_GB: float = 0.0
 
 
-    def __init__(self):
-        args = self.parse_args()
+    def __init__(self, **kwargs):
+        args = {**self.parse_args(), **kwargs} # Keyword arguments override argv
         data_manifest_path: str = args["data_manifest"]
         bands: List[str] = args["bands"]
-        with open(data_manifest_path) as f:
-            data_dict = json.load(f)
+        data_dict: dict = load_json(data_manifest_path)
         self.args = args
 
         dir_path = data_dict["dir_path"]
-        filepaths = glob.glob(dir_path + "/**/*.tif", recursive=True)
-        self.filepaths = filepaths
+        filepaths = list(scan_files(dir_path, (".tif", ".tiff")))
+        self.filepaths = StringArray(filepaths)
         self.categories = data_dict["categories"]
         self.bands = bands
+        self.gdal_bands: List[int] = [int(band) + 1 for band in bands] # GDAL bands are 1-indexed
         self.use_data_aug = arg_is_true(args["use_data_aug"])
+        if self.use_data_aug:
+            self.batch_transforms = BatchAugmentation()
+        else:
+            self.batch_transforms = None
 
         self.class_weights = [1.0, 1.0]
 
+        if arg_is_true(args["validate_paths"]):
+            validate_paths(self.filepaths)
+
+        self.targets: torch.Tensor = torch.as_tensor(self.get_labels()) # int64
+        self.targets.share_memory_()
+
+        cache_path: Optional[str] = args["cache_path"]
+        if cache_path:
+            self.cache, meta = get_memmap_cache(
+                cache_path=cache_path, load_fn=self.load_sample, 
+                sample_ids=list(self.filepaths), meta={"labels": self.targets.numpy()}
+            )
+            if not np.array_equal(meta["labels"], self.targets.numpy()):
+                raise ValueError(
+                    f"Labels in cache {cache_path} do not match the manifest."
+                )
+        else:
+            self.cache = None
+        # Only needed when the samples aren't already memory-mapped
+        self.ram_cache: Optional[SampleCache] = get_sample_cache(
+            args["ram_cache_gb"] if self.cache is None else 0.0
+        )
+
 
     def parse_args(self):
         parser = argparse.ArgumentParser()
@@ -63,6 +586,21 @@ class EurosatDataset(Dataset):
             "--use-data-aug",
             default=self.DEFAULT_USE_DATA_AUG
         )
+        parser.add_argument(
+            "--cache-path",
+            default=self.DEFAULT_CACHE_PATH
+        )
+        parser.add_argument(
+            "--ram-cache-gb",
+            default=self.DEFAULT_RAM_CACHE_GB,
+            help="Total RAM (GiB) for caching decoded samples, split evenly "
+            "across DataLoader worker processes.",
+            type=float
+        )
+        parser.add_argument(
+            "--validate-paths",
+            default=self.DEFAULT_VALIDATE_PATHS
+        )
         args = parse_args(parser=parser)
         return args        
 
@@ -71,20 +609,35 @@ class EurosatDataset(Dataset):
         return len(self.filepaths)
 
 
+    def get_labels(self) -> np.ndarray:
+        labels: list = [
+            self.categories[self.get_category_from_filepath(filepath)] \
+                for filepath in self.filepaths
+        ]
+        return np.asarray(labels, dtype=np.int64)
+
+
     @staticmethod
     def get_category_from_filepath(filepath):
-        return filepath.replace("\\", "/").split("/")[-2]
+        return os.path.basename(os.path.dirname(filepath))
 
 
     def load(self, filepath):
         ext = filepath.split(".")[-1]
         if ext in ['tif', 'tiff']:
             try:
-                image = gdal.Open(str(filepath)).ReadAsArray().astype(np.int16)
-            except AttributeError as e:
+                ds = gdal.OpenEx(str(filepath), gdal.OF_RASTER | gdal.OF_READONLY)
+                # Read only the requested bands, straight into an int16 buffer
+                image = np.empty(
+                    (len(self.gdal_bands), ds.RasterYSize, ds.RasterXSize),
+                    dtype=np.int16
+                )
+                ds.ReadAsArray(band_list=self.gdal_bands, buf_obj=image) # One RasterIO call
+                ds = None # Closes the file
+            except (AttributeError, RuntimeError) as e:
                 print(f"Problem loading {filepath}.")
                 raise e
-            return image[self.bands]
+            return image
         else:
             raise NotImplementedError(
                 f"Expects .tif or .tiff files. Received .{ext}."
@@ -92,57 +645,28 @@ class EurosatDataset(Dataset):
 
 
     @staticmethod
-    def preprocess(image, max_pix_value = 10000):
-        return image / max_pix_value
+    def preprocess(image: torch.Tensor, max_pix_value = 10000) -> torch.Tensor:
+        # One cast (the only copy) followed by an in-place scale
+        return image.to(torch.float32).mul_(1.0 / max_pix_value)
 
 
-    @staticmethod
-    def horizontal_flip(image, p = 0.75):
-        if random.random() > p:
-            image = TF.hflip(image)
-        
-        return image
-
-
-    @staticmethod
-    def vertical_flip(image, p = 0.75):
-        if random.random() > p:
-            image = TF.vflip(image)
-        
-        return image
-
-
-    @staticmethod
-    def rotate(image, p = 0.75, max_angle = 30):
-        if random.random() > p:
-            angle = random.randint(- max_angle, max_angle)
-            image = TF.rotate(image, angle)
-        
-        return image
-
-
-    def __getitem__(self, idx):
+    def load_sample(self, idx: int) -> np.ndarray:
         filepath = self.filepaths[idx]
+        return self.load(filepath)
 
-        assert os.path.exists(filepath), f"File {filepath} does not exist."
 
-        category = self.get_category_from_filepath(filepath)
-        target = self.categories[category]
+    def __getitem__(self, idx):
+        if self.cache is not None:
+            image = self.cache[idx]
+        elif self.ram_cache is not None:
+            image = self.ram_cache.get(idx, self.load_sample)
+        else:
+            image = self.load_sample(idx)
 
-        image = self.load(filepath)
-        image = self.preprocess(image)   
+        image = torch.from_numpy(np.ascontiguousarray(image)) # int16, zero-copy
+        image = self.preprocess(image)
 
-        image = torch.as_tensor(image.copy()).float().contiguous()
-        target = torch.as_tensor(target)
-        
-        if self.use_data_aug:
-            transform_idx = random.randint(0, 2)
-            if transform_idx == 0:
-                image = self.horizontal_flip(image)
-            elif transform_idx == 1:
-                image = self.vertical_flip(image)
-            else:
-                image = self.rotate(image)           
+        target = self.targets[idx]
 
         return {
             'X': image,
@@ -157,37 +681,48 @@ class XYZTileDataset(Dataset):
     DEFAULT_USE_DATA_AUG: bool = True
     DEFAULT_USE_ROTATION: bool = False
     DEFAULT_USE_SQRT_WEIGHTS: bool = False
+    DEFAULT_CACHE_PATH: Optional[str] = None
+    DEFAULT_VALIDATE_PATHS: bool = False
+    DEFAULT_USE_INDEX_CACHE: bool = False
+    DEFAULT_RAM_CACHE_GB: float = 0.0
     MAX_ANGLE: int = 30
     INPUT_SIZE: Tuple[int, int] = (224, 224)
 
 
-    def __init__(self):
-        args = self.parse_args()
+    def __init__(self, **kwargs):
+        args = {**self.parse_args(), **kwargs} # Keyword arguments override argv
         data_manifest_path = args["data_manifest"]
-        with open(data_manifest_path) as f:
-            data_dict = json.load(f)
+        data_dict: dict = load_json(data_manifest_path)
         use_sqrt_weights = arg_is_true(args["use_sqrt_weights"])
         self.args = args            
 
         dir_path = data_dict["dir_path"]
         num_pos: int = 0
         num_neg: int = 0
-        samples = list()
-        for dirpath, dirnames, filenames in os.walk(dir_path):
-            if not dirnames:
-                for key, value in data_dict["categories"].items():
-                    if key in dirpath:
-                        for filename in filenames:
-                            if value:
-                                num_pos += 1
-                            else:
-                                num_neg += 1                            
-                            sample_dict = {
-                                "dirpath": dirpath,
-                                "filename": filename,
-                                "label": value
-                            }
-                            samples.append(sample_dict)
+        # Samples are stored as parallel lists rather than a list of dicts
+        sample_filepaths: List[str] = list()
+        sample_labels: List[int] = list()
+        categories: dict = data_dict["categories"]
+        category_re: re.Pattern = compile_key_matcher(categories)
+        if arg_is_true(args["use_index_cache"]):
+            index_cache_path: Optional[str] = data_manifest_path + ".index.pkl"
+        else:
+            index_cache_path = None
+        leaf_dirs: List[Tuple[str, List[str]]] = get_leaf_dirs(
+            dir_path, cache_path=index_cache_path
+        )
+        for dirpath, filenames in leaf_dirs:
+            match = category_re.search(dirpath)
+            if match is None:
+                continue
+            value = categories[match.group(0)]
+            for filename in filenames:
+                if value:
+                    num_pos += 1
+                else:
+                    num_neg += 1                            
+                sample_filepaths.append(join_path(dirpath, filename))
+                sample_labels.append(value)
         neg_class_weight = 1 - ((num_neg) / (num_neg + num_pos))
         pos_class_weight = 1 - ((num_pos) / (num_neg + num_pos))
         if use_sqrt_weights: # Smooth out weights if desired
@@ -196,20 +731,44 @@ class XYZTileDataset(Dataset):
         class_weights = [neg_class_weight, pos_class_weight]
         self.class_weights = class_weights
 
-        self.transforms = T.Compose([
-            T.Resize(self.INPUT_SIZE),
-            # T.CenterCrop((224,224)),
-            T.ToTensor(),
-            T.Normalize(
-                mean=[0.485, 0.456, 0.406],
-                std=[0.229, 0.224, 0.225]
-            )
-        ])                
+        self.resize = T.Resize(self.INPUT_SIZE, antialias=True) # Applied to uint8 images
+        # self.center_crop = T.CenterCrop((224,224))
 
-        self.samples = samples
+        self.filepaths = StringArray(sample_filepaths)
+        self.labels: np.ndarray = np.asarray(sample_labels, dtype=np.int8)
         self.categories = data_dict["categories"]
         self.use_data_aug = arg_is_true(args["use_data_aug"])
         self.use_rotation = arg_is_true(args["use_rotation"])
+        if self.use_data_aug:
+            self.batch_transforms = BatchAugmentation(
+                max_angle=self.MAX_ANGLE, use_rotation=self.use_rotation
+            )
+        else:
+            self.batch_transforms = None
+
+        if arg_is_true(args["validate_paths"]):
+            validate_paths(list(self.filepaths))
+
+        self.targets: torch.Tensor = torch.from_numpy(self.labels.astype(np.int64))
+        self.targets.share_memory_()
+
+        cache_path: Optional[str] = args["cache_path"]
+        if cache_path:
+            self.cache, meta = get_memmap_cache(
+                cache_path=cache_path, load_fn=self.load_sample, 
+                sample_ids=list(self.filepaths), 
+                meta={"labels": self.targets.numpy()}, image_size=self.INPUT_SIZE
+            )
+            if not np.array_equal(meta["labels"], self.targets.numpy()):
+                raise ValueError(
+                    f"Labels in cache {cache_path} do not match the manifest."
+                )
+        else:
+            self.cache = None
+        # Only needed when the samples aren't already memory-mapped
+        self.ram_cache: Optional[SampleCache] = get_sample_cache(
+            args["ram_cache_gb"] if self.cache is None else 0.0
+        )
 
 
     def parse_args(self):
@@ -230,16 +789,35 @@ class XYZTileDataset(Dataset):
             "--use-sqrt-weights",
             default=self.DEFAULT_USE_SQRT_WEIGHTS
         )
+        parser.add_argument(
+            "--cache-path",
+            default=self.DEFAULT_CACHE_PATH
+        )
+        parser.add_argument(
+            "--ram-cache-gb",
+            default=self.DEFAULT_RAM_CACHE_GB,
+            help="Total RAM (GiB) for caching decoded samples, split evenly "
+            "across DataLoader worker processes.",
+            type=float
+        )
+        parser.add_argument(
+            "--validate-paths",
+            default=self.DEFAULT_VALIDATE_PATHS
+        )
+        parser.add_argument(
+            "--use-index-cache",
+            default=self.DEFAULT_USE_INDEX_CACHE
+        )
         args = parse_args(parser=parser)
         return args              
 
 
     def __len__(self):
-        return len(self.samples)    
+        return len(self.filepaths)    
 
 
-    def read_png(self, filepath: str) -> np.ndarray:
-        img = Image.open(filepath).convert('RGB')
+    def read_png(self, filepath: str) -> torch.Tensor:
+        img = read_image_rgb(filepath) # C x H x W, uint8
         return img
 
 
@@ -255,44 +833,26 @@ class XYZTileDataset(Dataset):
         return filenames_sorted      
 
 
-    def spatial_transform(
-        self, image: torch.Tensor, angle: int, idx: int
-    ) -> torch.Tensor:
-        if idx == 0:
-            return image
-        elif idx == 1:
-            image = TF.vflip(image)
-        elif idx == 2:
-            image = TF.hflip(image)
-        else:
-            image = TF.rotate(image, angle)  
-        return image        
+    def get_filepath(self, idx: int) -> str:
+        return self.filepaths[idx]
 
 
-    def __getitem__(self, idx):
-        sample = self.samples[idx]
+    def load_sample(self, idx: int) -> torch.Tensor:
+        filepath: str = self.get_filepath(idx)
+        image: torch.Tensor = self.read_png(filepath=filepath)
+        image: torch.Tensor = self.resize(image)
+        return image
 
-        dirpath: str = sample["dirpath"]
-        filename: str = sample["filename"]
-        
-        if self.use_data_aug:
-            if self.use_rotation:
-                transform_idx = random.randint(0, 3) 
-                random_angle: int = random.randint(-self.MAX_ANGLE, self.MAX_ANGLE)
-            else:
-                transform_idx = random.randint(0, 2) # No rotation
-                random_angle: int = 0
 
-        filepath: str = os.path.join(dirpath, filename).replace("\\", "/")
-        assert os.path.exists(filepath), f"File {filepath} does not exist."
-        image: torch.Tensor = self.read_png(filepath=filepath)
-        image: torch.Tensor = self.transforms(image)
-        image: torch.Tensor = image.float().contiguous()
-        if self.use_data_aug:
-            image = self.spatial_transform(
-                image, angle=random_angle, idx=transform_idx
-            )
-        target: torch.Tensor = torch.as_tensor(sample["label"])
+    def __getitem__(self, idx):
+        if self.cache is not None:
+            image: torch.Tensor = torch.from_numpy(self.cache[idx])
+        elif self.ram_cache is not None:
+            image: torch.Tensor = self.ram_cache.get(idx, self.load_sample)
+        else:
+            image: torch.Tensor = self.load_sample(idx)
+        # Stays uint8; the model converts and normalizes it (`PreNormalize`)
+        target: torch.Tensor = self.targets[idx]
 
         return {
             'X': image,
@@ -307,36 +867,52 @@ class ConvLSTMCDataset(Dataset):
     DEFAULT_USE_DATA_AUG: bool = True
     DEFAULT_USE_ROTATION: bool = False
     DEFAULT_USE_SQRT_WEIGHTS: bool = False
+    DEFAULT_CACHE_PATH: Optional[str] = None
+    DEFAULT_VALIDATE_PATHS: bool = False
+    DEFAULT_USE_INDEX_CACHE: bool = False
+    DEFAULT_RAM_CACHE_GB: float = 0.0
+    DEFAULT_FRAME_THREADS: int = 0 # If > 0, decode a sample's frames in parallel
     MAX_ANGLE: int = 30
     INPUT_SIZE: Tuple[int, int] = (224,224)
 
 
-    def __init__(self):
-        args = self.parse_args()
+    def __init__(self, **kwargs):
+        args = {**self.parse_args(), **kwargs} # Keyword arguments override argv
         data_manifest_path = args["data_manifest"]
-        with open(data_manifest_path) as f:
-            data_dict = json.load(f)
+        data_dict: dict = load_json(data_manifest_path)
         use_sqrt_weights = arg_is_true(args["use_sqrt_weights"])
         self.args = args            
 
         dir_path = data_dict["dir_path"]
         num_pos: int = 0
         num_neg: int = 0
-        samples = list()
-        for dirpath, dirnames, filenames in os.walk(dir_path):
-            if not dirnames:
-                for key, value in data_dict["categories"].items():
-                    if key in dirpath:
-                        if value:
-                            num_pos += 1
-                        else:
-                            num_neg += 1
-                        sample_dict = {
-                            "dirpath": dirpath,
-                            "filenames": filenames,
-                            "label": value
-                        }
-                        samples.append(sample_dict)
+        # Samples are stored as parallel lists rather than a list of dicts
+        sample_dirpaths: List[str] = list()
+        sample_filepaths: List[List[str]] = list()
+        sample_labels: List[int] = list()
+        categories: dict = data_dict["categories"]
+        category_re: re.Pattern = compile_key_matcher(categories)
+        if arg_is_true(args["use_index_cache"]):
+            index_cache_path: Optional[str] = data_manifest_path + ".index.pkl"
+        else:
+            index_cache_path = None
+        leaf_dirs: List[Tuple[str, List[str]]] = get_leaf_dirs(
+            dir_path, cache_path=index_cache_path
+        )
+        for dirpath, filenames in leaf_dirs:
+            match = category_re.search(dirpath)
+            if match is None:
+                continue
+            value = categories[match.group(0)]
+            if value:
+                num_pos += 1
+            else:
+                num_neg += 1
+            sample_dirpaths.append(dirpath)
+            sample_filepaths.append([
+                join_path(dirpath, filename) for filename in self.sort_filenames(filenames)
+            ])
+            sample_labels.append(value)
         neg_class_weight = 1 - ((num_neg) / (num_neg + num_pos))
         pos_class_weight = 1 - ((num_pos) / (num_neg + num_pos))
         if use_sqrt_weights: # Smooth out weights if desired
@@ -345,20 +921,54 @@ class ConvLSTMCDataset(Dataset):
         class_weights = [neg_class_weight, pos_class_weight]
         self.class_weights = class_weights
 
-        self.transforms = T.Compose([
-            T.Resize(self.INPUT_SIZE),
-            # T.CenterCrop((224,224)),
-            T.ToTensor(),
-            T.Normalize(
-                mean=[0.485, 0.456, 0.406],
-                std=[0.229, 0.224, 0.225]
-            )
-        ])                
-
-        self.samples = samples
+        self.resize = T.Resize(self.INPUT_SIZE, antialias=True) # Applied to uint8 images
+        # self.center_crop = T.CenterCrop((224,224))
+
+        self.dirpaths = StringArray(sample_dirpaths)
+        # Frame filepaths of all samples, flattened; sample `idx` owns
+        # `self.filepaths[frame_offsets[idx]:frame_offsets[idx + 1]]`
+        frame_offsets: np.ndarray = np.zeros(len(sample_filepaths) + 1, dtype=np.int64)
+        np.cumsum([len(filepaths) for filepaths in sample_filepaths], out=frame_offsets[1:])
+        self.frame_offsets: torch.Tensor = torch.from_numpy(frame_offsets).share_memory_()
+        self.filepaths = StringArray(
+            [filepath for filepaths in sample_filepaths for filepath in filepaths]
+        )
+        self.labels: np.ndarray = np.asarray(sample_labels, dtype=np.int8)
         self.categories = data_dict["categories"]
+        self.frame_threads: int = args["frame_threads"]
         self.use_data_aug = arg_is_true(args["use_data_aug"])
         self.use_rotation = arg_is_true(args["use_rotation"])
+        if self.use_data_aug:
+            self.batch_transforms = BatchAugmentation(
+                max_angle=self.MAX_ANGLE, use_rotation=self.use_rotation, 
+                time_series=True
+            )
+        else:
+            self.batch_transforms = None
+
+        if arg_is_true(args["validate_paths"]):
+            validate_paths(list(self.filepaths))
+
+        self.targets: torch.Tensor = torch.from_numpy(self.labels.astype(np.int64))
+        self.targets.share_memory_()
+
+        cache_path: Optional[str] = args["cache_path"]
+        if cache_path:
+            self.cache, meta = get_memmap_cache(
+                cache_path=cache_path, load_fn=self.load_sample, 
+                sample_ids=list(self.dirpaths), 
+                meta={"labels": self.targets.numpy()}, image_size=self.INPUT_SIZE
+            )
+            if not np.array_equal(meta["labels"], self.targets.numpy()):
+                raise ValueError(
+                    f"Labels in cache {cache_path} do not match the manifest."
+                )
+        else:
+            self.cache = None
+        # Only needed when the samples aren't already memory-mapped
+        self.ram_cache: Optional[SampleCache] = get_sample_cache(
+            args["ram_cache_gb"] if self.cache is None else 0.0
+        )
 
 
     def parse_args(self):
@@ -379,16 +989,40 @@ class ConvLSTMCDataset(Dataset):
             "--use-sqrt-weights",
             default=self.DEFAULT_USE_SQRT_WEIGHTS
         )
+        parser.add_argument(
+            "--cache-path",
+            default=self.DEFAULT_CACHE_PATH
+        )
+        parser.add_argument(
+            "--ram-cache-gb",
+            default=self.DEFAULT_RAM_CACHE_GB,
+            help="Total RAM (GiB) for caching decoded samples, split evenly "
+            "across DataLoader worker processes.",
+            type=float
+        )
+        parser.add_argument(
+            "--validate-paths",
+            default=self.DEFAULT_VALIDATE_PATHS
+        )
+        parser.add_argument(
+            "--use-index-cache",
+            default=self.DEFAULT_USE_INDEX_CACHE
+        )
+        parser.add_argument(
+            "--frame-threads",
+            default=self.DEFAULT_FRAME_THREADS,
+            type=int
+        )
         args = parse_args(parser=parser)
         return args              
 
 
     def __len__(self):
-        return len(self.samples)    
+        return len(self.dirpaths)    
 
 
-    def read_png(self, filepath: str) -> np.ndarray:
-        img = Image.open(filepath).convert('RGB')
+    def read_png(self, filepath: str) -> torch.Tensor:
+        img = read_image_rgb(filepath) # C x H x W, uint8
         return img
 
 
@@ -404,52 +1038,42 @@ class ConvLSTMCDataset(Dataset):
         return filenames_sorted
 
 
-    def spatial_transform(
-        self, image: torch.Tensor, angle: int, idx: int
-    ) -> torch.Tensor:
-        if idx == 0:
-            return image
-        elif idx == 1:
-            image = TF.vflip(image)
-        elif idx == 2:
-            image = TF.hflip(image)
-        else:
-            image = TF.rotate(image, angle)  
-        return image   
+    def get_filepaths(self, idx: int) -> List[str]:
+        start, end = self.frame_offsets[idx:idx + 2].tolist()
+        return [self.filepaths[i] for i in range(start, end)] # Sorted at init
 
 
-    def __getitem__(self, idx):
-        sample = self.samples[idx]
-
-        image_arrays: list = list()
-        dirpath: str = sample["dirpath"]
-        filenames: List[str] = self.sort_filenames(sample["filenames"])
-        
-        if self.use_data_aug:
-            if self.use_rotation:
-                transform_idx = random.randint(0, 3) 
-                random_angle: int = random.randint(-self.MAX_ANGLE, self.MAX_ANGLE)
-            else:
-                transform_idx = random.randint(0, 2) # No rotation
-                random_angle: int = 0
+    def load_sample(self, idx: int) -> torch.Tensor:
+        filepaths: List[str] = self.get_filepaths(idx)
+        if self.frame_threads > 0:
+            pool: ThreadPoolExecutor = get_thread_pool(self.frame_threads)
+            images: List[torch.Tensor] = list(pool.map(self.read_png, filepaths))
+        else:
+            images: List[torch.Tensor] = [
+                self.read_png(filepath=filepath) for filepath in filepaths
+            ]
+        if all(image.shape == images[0].shape for image in images):
+            # Resize every frame with one call
+            return self.resize(torch.stack(images, 0)) # T x C x H x W, uint8
+        image_arrays: torch.Tensor = torch.empty(
+            (len(filepaths), 3, *self.INPUT_SIZE), dtype=torch.uint8
+        ) # T x C x H x W
+        for i, image in enumerate(images):
+            image_arrays[i].copy_(self.resize(image))
+        return image_arrays
 
-        for filename in filenames:
-            filepath: str = os.path.join(dirpath, filename).replace("\\", "/")
-            assert os.path.exists(filepath), f"File {filepath} does not exist."
-            image: torch.Tensor = self.read_png(filepath=filepath)
-            image: torch.Tensor = self.transforms(image)
-            image: torch.Tensor = image.float().contiguous()
-            # image: torch.Tensor = torch.as_tensor(arr.copy()).float().contiguous()
-            if self.use_data_aug:
-                image = self.spatial_transform(
-                    image, angle=random_angle, idx=transform_idx
-                )
-            image_arrays.append(image)
 
-        image_arrays = torch.stack(image_arrays, 0)
+    def __getitem__(self, idx):
+        if self.cache is not None:
+            image_arrays: torch.Tensor = torch.from_numpy(self.cache[idx])
+        elif self.ram_cache is not None:
+            image_arrays: torch.Tensor = self.ram_cache.get(idx, self.load_sample)
+        else:
+            image_arrays: torch.Tensor = self.load_sample(idx)
+        # Stays uint8; the model converts and normalizes it (`PreNormalize`)
         # image_arrays = torch.swapaxes(image_arrays, 1, -1) # _ x W x H x C -> _ x C x H x W
 
-        target: torch.Tensor = torch.as_tensor(sample["label"])
+        target: torch.Tensor = self.targets[idx]
 
         return {
             'X': image_arrays,
@@ -457,24 +1081,25 @@ class ConvLSTMCDataset(Dataset):
         }
 
 
-class XYZObjectDetectionDataset(Dataset):
+class XYZObjectDetectionDataset(ScriptedTransformsMixin, Dataset):
     __name__ = "XYZObjectDetectionDataset"
 
     DEFAULT_DATA_MANIFEST: str = "sios_annotations_manifest.json"
     DEFAULT_ANNOTATIONS: str = "sios_annotations.json"
     DEFAULT_POS_ONLY: bool = True
+    DEFAULT_CACHE_PATH: Optional[str] = None
+    DEFAULT_VALIDATE_PATHS: bool = False
+    DEFAULT_USE_INDEX_CACHE: bool = False
     INPUT_SIZE: Tuple[int, int] = (224,224)
 
 
-    def __init__(self):
-        args = self.parse_args()
+    def __init__(self, **kwargs):
+        args = {**self.parse_args(), **kwargs} # Keyword arguments override argv
         data_manifest_path = args["data_manifest"]
-        with open(data_manifest_path) as f:
-            data_dict = json.load(f)
+        data_dict: dict = load_json(data_manifest_path)
 
         annotations_path = args["annotations_path"]
-        with open(annotations_path) as f:
-            annotations_dict: dict = json.load(f)
+        annotations_dict: dict = load_json(annotations_path)
 
         pos_only = arg_is_true(args["pos_only"])
         self.args = args            
@@ -482,40 +1107,66 @@ class XYZObjectDetectionDataset(Dataset):
         dir_path = data_dict["dir_path"]
         num_pos: int = 0
         num_neg: int = 0
-        samples = list()
-        for dirpath, dirnames, filenames in os.walk(dir_path):
-            if not dirnames:
-                for key, value in data_dict["categories"].items():
-                    if not value and pos_only:
-                        continue
-                    if key in dirpath:
-                        for tile_idx, annotation in annotations_dict.items():
-                            if tile_idx in dirpath:
-                                for filename in filenames:
-                                    if value:
-                                        num_pos += 1
-                                    else:
-                                        num_neg += 1                            
-                                    sample_dict = {
-                                        "dirpath": dirpath,
-                                        "filename": filename,
-                                        "annotation": annotation,
-                                        "label": value
-                                    }
-                                    samples.append(sample_dict)
-
-        self.transforms = T.Compose([
-            T.Resize(self.INPUT_SIZE),
-            # T.CenterCrop((224,224)),
-            T.ToTensor(),
-            # T.Normalize(
-            #     mean=[0.485, 0.456, 0.406],
-            #     std=[0.229, 0.224, 0.225]
-            # )
-        ])                
-
-        self.samples = samples
+        # Samples are stored as parallel lists rather than a list of dicts
+        sample_filepaths: List[str] = list()
+        sample_boxes: List[Tuple[float, float, float, float]] = list()
+        sample_labels: List[int] = list()
+        categories: dict = data_dict["categories"]
+        if pos_only:
+            categories = {key: value for key, value in categories.items() if value}
+        category_re: re.Pattern = compile_key_matcher(categories)
+        annotation_re: re.Pattern = compile_key_matcher(annotations_dict)
+        if arg_is_true(args["use_index_cache"]):
+            index_cache_path: Optional[str] = data_manifest_path + ".index.pkl"
+        else:
+            index_cache_path = None
+        leaf_dirs: List[Tuple[str, List[str]]] = get_leaf_dirs(
+            dir_path, cache_path=index_cache_path
+        )
+        for dirpath, filenames in leaf_dirs:
+            match = category_re.search(dirpath)
+            if match is None:
+                continue
+            value = categories[match.group(0)]
+            match = annotation_re.search(dirpath)
+            if match is None:
+                continue
+            box: tuple = self.annotation_to_box(annotations_dict[match.group(0)])
+            for filename in filenames:
+                if value:
+                    num_pos += 1
+                else:
+                    num_neg += 1                            
+                sample_filepaths.append(join_path(dirpath, filename))
+                sample_boxes.append(box)
+                sample_labels.append(value)
+
+        self.resize = T.Resize(self.INPUT_SIZE, antialias=True) # Applied to uint8 images
+        # self.center_crop = T.CenterCrop((224,224))
+
+        self.filepaths = StringArray(sample_filepaths)
+        # One (x_min, y_min, x_max, y_max) box per sample instead of a dict
+        self.boxes: torch.Tensor = torch.tensor(
+            sample_boxes, dtype=torch.float32
+        ).reshape(-1, 4).share_memory_()
+        self.labels: np.ndarray = np.asarray(sample_labels, dtype=np.int8)
         self.categories = data_dict["categories"]
+        self.batch_transforms = None
+
+        if arg_is_true(args["validate_paths"]):
+            validate_paths(list(self.filepaths))
+
+        cache_path: Optional[str] = args["cache_path"]
+        if cache_path:
+            self.cache, meta = get_memmap_cache(
+                cache_path=cache_path, load_fn=self.load_sample, 
+                sample_ids=list(self.filepaths), 
+                meta={"sizes": self.get_original_image_sizes()}, 
+                image_size=self.INPUT_SIZE
+            )
+            self.cache_sizes: np.ndarray = meta["sizes"]
+        else:
+            self.cache = None
 
 
     def parse_args(self):
@@ -532,16 +1183,28 @@ class XYZObjectDetectionDataset(Dataset):
             "--pos-only",
             default=self.DEFAULT_POS_ONLY
         )
+        parser.add_argument(
+            "--cache-path",
+            default=self.DEFAULT_CACHE_PATH
+        )
+        parser.add_argument(
+            "--validate-paths",
+            default=self.DEFAULT_VALIDATE_PATHS
+        )
+        parser.add_argument(
+            "--use-index-cache",
+            default=self.DEFAULT_USE_INDEX_CACHE
+        )
         args = parse_args(parser=parser)
         return args              
 
 
     def __len__(self):
-        return len(self.samples)    
+        return len(self.filepaths)    
 
 
-    def read_png(self, filepath: str) -> np.ndarray:
-        img = Image.open(filepath).convert('RGB')
+    def read_png(self, filepath: str) -> torch.Tensor:
+        img = read_image_rgb(filepath) # C x H x W, uint8
         return img
 
 
@@ -558,10 +1221,7 @@ class XYZObjectDetectionDataset(Dataset):
 
 
     @staticmethod
-    def make_bounding_box_from_annotation(
-        annotation: dict, original_image_size: Optional[Tuple[int]] = None,
-        transformed_image_size: Optional[Tuple[int]] = None
-    ) -> torch.Tensor:
+    def annotation_to_box(annotation: dict) -> Tuple[float, float, float, float]:
         x = annotation["x"]
         y = annotation["y"]
         width = annotation["width"]
@@ -572,44 +1232,41 @@ class XYZObjectDetectionDataset(Dataset):
 
         x_max = x + width
         y_max = y + height
+        return x, y, x_max, y_max
 
-        if original_image_size is not None and transformed_image_size is not None:
-            original_image_width, original_image_height = original_image_size
-            transformed_image_width, transformed_image_height = transformed_image_size
-            width_ratio = transformed_image_width / original_image_width
-            height_ratio = transformed_image_height / original_image_height
-            x = x * width_ratio
-            y = y * height_ratio
-            x_max = x_max * width_ratio
-            y_max = y_max * height_ratio        
-
-        boxes = torch.tensor([x, y, x_max, y_max])
-        labels = torch.ones(1, dtype=torch.int64)
-        
-        target = dict()
-        target["boxes"] = boxes.unsqueeze(0)
-        target["labels"] = labels
-        # target["image_id"] = [index]
-        # target["area"] = area
-        return target
 
+    def get_filepath(self, idx: int) -> str:
+        return self.filepaths[idx]
 
-    def __getitem__(self, idx):
-        sample = self.samples[idx]
 
-        dirpath: str = sample["dirpath"]
-        filename: str = sample["filename"]
-        annotation: dict = sample["annotation"]
+    def get_original_image_sizes(self) -> np.ndarray:
+        sizes = np.empty((len(self), 2), dtype=np.int64)
+        for idx in range(len(self)):
+            width, height = Image.open(self.get_filepath(idx)).size # Header only
+            sizes[idx] = (width, height)
+        return sizes
+
+
+    def load_sample(self, idx: int) -> torch.Tensor:
+        filepath: str = self.get_filepath(idx)
+        image: torch.Tensor = self.read_png(filepath=filepath)
+        image: torch.Tensor = self.resize(image)
+        return image
+
 
-        filepath: str = os.path.join(dirpath, filename).replace("\\", "/")
-        assert os.path.exists(filepath), f"File {filepath} does not exist."
-        image = self.read_png(filepath=filepath)
-        original_image_size: tuple = image.size
-        image: torch.Tensor = self.transforms(image)
-        image: torch.Tensor = image.float().contiguous()
+    def __getitem__(self, idx):
+        if self.cache is not None:
+            image: torch.Tensor = torch.from_numpy(self.cache[idx])
+            original_image_size: tuple = tuple(self.cache_sizes[idx].tolist()) # (W, H)
+        else:
+            filepath: str = self.get_filepath(idx)
+            image: torch.Tensor = self.read_png(filepath=filepath)
+            original_image_size: tuple = (image.shape[-1], image.shape[-2]) # (W, H)
+            image: torch.Tensor = self.resize(image)
+        image: torch.Tensor = self.apply_transforms(image)
 
-        target: torch.Tensor = self.make_bounding_box_from_annotation(
-            annotation=annotation, original_image_size=original_image_size,
+        target: dict = make_box_target(
+            boxes=self.boxes[idx:idx + 1], original_image_size=original_image_size,
             transformed_image_size=self.INPUT_SIZE
         )
 
@@ -621,7 +1278,7 @@ class XYZObjectDetectionDataset(Dataset):
         # }
 
 
-class XYZObjectDetectionDatasetTwo(Dataset):
+class XYZObjectDetectionDatasetTwo(ScriptedTransformsMixin, Dataset):
     """
     Even better than the original.
     """
@@ -630,18 +1287,18 @@ class XYZObjectDetectionDatasetTwo(Dataset):
     DEFAULT_DATA_MANIFEST: str = "sios_annotations_manifest.json"
     DEFAULT_ANNOTATIONS: str = "sios_annotations.json"
     DEFAULT_POS_ONLY: bool = True
+    DEFAULT_CACHE_PATH: Optional[str] = None
+    DEFAULT_VALIDATE_PATHS: bool = False
     INPUT_SIZE: Tuple[int, int] = (224,224)
 
 
-    def __init__(self):
-        args = self.parse_args()
+    def __init__(self, **kwargs):
+        args = {**self.parse_args(), **kwargs} # Keyword arguments override argv
         data_manifest_path = args["data_manifest"]
-        with open(data_manifest_path) as f:
-            data_dict = json.load(f)
+        data_dict: dict = load_json(data_manifest_path)
 
         annotations_path = args["annotations_path"]
-        with open(annotations_path) as f:
-            annotations_dict: dict = json.load(f)
+        annotations_dict: dict = load_json(annotations_path)
 
         pos_only = arg_is_true(args["pos_only"])
         self.args = args            
@@ -679,17 +1336,42 @@ class XYZObjectDetectionDatasetTwo(Dataset):
         #                             samples.append(sample_dict)
 
 
-        self.transforms = T.Compose([
-            T.Resize(self.INPUT_SIZE),
-            # T.CenterCrop((224,224)),
-            T.ToTensor(),
-            # T.Normalize(
-            #     mean=[0.485, 0.456, 0.406],
-            #     std=[0.229, 0.224, 0.225]
-            # )
-        ])          
-        self.samples = samples
+        self.resize = T.Resize(self.INPUT_SIZE, antialias=True) # Applied to uint8 images
+        # self.center_crop = T.CenterCrop((224,224))
+        # The sample dicts are flattened: one packed array of filepaths, and
+        # every sample's boxes concatenated into one `sum(N_i) x 4` tensor,
+        # with sample `idx` owning rows `box_offsets[idx]:box_offsets[idx + 1]`
+        sample_boxes: List[np.ndarray] = [
+            self.annotations_to_boxes(sample["annotations"]) for sample in samples
+        ]
+        num_boxes = np.fromiter(
+            (len(boxes) for boxes in sample_boxes), dtype=np.int64, 
+            count=len(sample_boxes)
+        )
+        self.filepaths = StringArray([sample["filepath"] for sample in samples])
+        self.boxes: torch.Tensor = torch.from_numpy(
+            np.concatenate([np.empty((0, 4), dtype=np.float32), *sample_boxes])
+        ).share_memory_()
+        self.box_offsets: torch.Tensor = torch.from_numpy(
+            np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(num_boxes)])
+        ).share_memory_()
         self.categories = data_dict["categories"]
+        self.batch_transforms = None
+
+        if arg_is_true(args["validate_paths"]):
+            validate_paths(list(self.filepaths))
+
+        cache_path: Optional[str] = args["cache_path"]
+        if cache_path:
+            self.cache, meta = get_memmap_cache(
+                cache_path=cache_path, load_fn=self.load_sample, 
+                sample_ids=list(self.filepaths), 
+                meta={"sizes": self.get_original_image_sizes()}, 
+                image_size=self.INPUT_SIZE
+            )
+            self.cache_sizes: np.ndarray = meta["sizes"]
+        else:
+            self.cache = None
 
 
     def parse_args(self):
@@ -706,16 +1388,24 @@ class XYZObjectDetectionDatasetTwo(Dataset):
             "--pos-only",
             default=self.DEFAULT_POS_ONLY
         )
+        parser.add_argument(
+            "--cache-path",
+            default=self.DEFAULT_CACHE_PATH
+        )
+        parser.add_argument(
+            "--validate-paths",
+            default=self.DEFAULT_VALIDATE_PATHS
+        )
         args = parse_args(parser=parser)
         return args              
 
 
     def __len__(self):
-        return len(self.samples)    
+        return len(self.filepaths)    
 
 
-    def read_png(self, filepath: str) -> np.ndarray:
-        img = Image.open(filepath).convert('RGB')
+    def read_png(self, filepath: str) -> torch.Tensor:
+        img = read_image_rgb(filepath) # C x H x W, uint8
         return img
 
 
@@ -732,68 +1422,53 @@ class XYZObjectDetectionDatasetTwo(Dataset):
 
 
     @staticmethod
-    def make_bounding_box_from_annotation(
-        annotations: dict, original_image_size: Optional[Tuple[int]] = None,
-        transformed_image_size: Optional[Tuple[int]] = None
-    ) -> torch.Tensor:
-        boxes: list = list()
-        labels: list = list()
-        if annotations is None:
-            target = dict()
-            target["boxes"] = torch.empty((0,4))
-            target["labels"] = torch.empty((0), dtype=torch.int64)
-            return target
+    def annotations_to_boxes(annotations: Optional[dict]) -> np.ndarray:
+        if annotations is None: # Negative sample
+            return np.empty((0, 4), dtype=np.float32)
         regions: List[dict] = annotations["regions"]
-        for region in regions:
-            region_data: dict = region["shape_attributes"]
-            x = region_data["x"]
-            y = region_data["y"]
-            width = region_data["width"]
-            height = region_data["height"]
-
-            x_max = x + width
-            y_max = y + height
-
-            if original_image_size is not None and transformed_image_size is not None:
-                original_image_width, original_image_height = original_image_size
-                transformed_image_width, transformed_image_height = transformed_image_size
-                width_ratio = transformed_image_width / original_image_width
-                height_ratio = transformed_image_height / original_image_height
-                x = x * width_ratio
-                y = y * height_ratio
-                x_max = x_max * width_ratio
-                y_max = y_max * height_ratio
-
-            box = [x, y, x_max, y_max]
-
-            boxes.append(box)
-            labels.append(1)
-        
-        target = dict()
-        target["boxes"] = torch.tensor(boxes)
-        target["labels"] = torch.tensor(labels, dtype=torch.int64)
-        # target["image_id"] = [index]
-        # target["area"] = area
-        return target
+        boxes: np.ndarray = np.fromiter(
+            (
+                value for region in regions \
+                    for value in (
+                        region["shape_attributes"]["x"],
+                        region["shape_attributes"]["y"],
+                        region["shape_attributes"]["x"] + region["shape_attributes"]["width"],
+                        region["shape_attributes"]["y"] + region["shape_attributes"]["height"]
+                    )
+            ), dtype=np.float32, count=4 * len(regions)
+        ).reshape(-1, 4) # N x (x_min, y_min, x_max, y_max)
+        return boxes
+
+
+    def get_original_image_sizes(self) -> np.ndarray:
+        sizes = np.empty((len(self), 2), dtype=np.int64)
+        for idx, filepath in enumerate(self.filepaths):
+            width, height = Image.open(filepath).size # Header only
+            sizes[idx] = (width, height)
+        return sizes
+
+
+    def load_sample(self, idx: int) -> torch.Tensor:
+        filepath: str = self.filepaths[idx]
+        image: torch.Tensor = self.read_png(filepath=filepath)
+        image: torch.Tensor = self.resize(image)
+        return image
 
 
     def __getitem__(self, idx):
-        sample = self.samples[idx]
-
-        # dirpath: str = sample["dirpath"]
-        # filename: str = sample["filename"]
-        annotations: dict = sample["annotations"]
-
-        # filepath: str = os.path.join(dirpath, filename).replace("\\", "/")
-        filepath: str = sample["filepath"]
-        assert os.path.exists(filepath), f"File {filepath} does not exist."
-        image = self.read_png(filepath=filepath)
-        original_image_size: tuple = image.size
-        image: torch.Tensor = self.transforms(image)
-        image: torch.Tensor = image.float().contiguous()
-
-        target: torch.Tensor = self.make_bounding_box_from_annotation(
-            annotations=annotations, original_image_size=original_image_size,
+        if self.cache is not None:
+            image: torch.Tensor = torch.from_numpy(self.cache[idx])
+            original_image_size: tuple = tuple(self.cache_sizes[idx].tolist()) # (W, H)
+        else:
+            filepath: str = self.filepaths[idx]
+            image: torch.Tensor = self.read_png(filepath=filepath)
+            original_image_size: tuple = (image.shape[-1], image.shape[-2]) # (W, H)
+            image: torch.Tensor = self.resize(image)
+        image: torch.Tensor = self.apply_transforms(image)
+
+        start, end = self.box_offsets[idx:idx + 2].tolist()
+        target: dict = make_box_target(
+            boxes=self.boxes[start:end], original_image_size=original_image_size,
             transformed_image_size=self.INPUT_SIZE
         )
 
@@ -9,7 +9,6 @@ import math
 import sys
 from typing import Sequence
 
-import numpy as np
 import torch
 import torchvision
 from torch.autograd import Variable
@@ -129,11 +128,11 @@ def train_one_epoch(
     device, lr_scheduler = None, 
 ) -> float:
     model.train()
-    running_loss = 0.0
+    running_loss = torch.zeros((), device=device)
 
     for (inputs, targets) in data_loader:
-        inputs = [Variable(input).to(device) for input in inputs]
-        targets = [{k: Variable(v).to(device) for k, v in t.items()} for t in targets]
+        inputs = [Variable(input).to(device, non_blocking=True) for input in inputs]
+        targets = [{k: Variable(v).to(device, non_blocking=True) for k, v in t.items()} for t in targets]
 
         loss_dict = model(inputs, targets)
         losses = sum(loss for loss in loss_dict.values())
@@ -142,18 +141,22 @@ def train_one_epoch(
             print("Loss dict:\n", loss_dict)
             sys.exit(1)
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         losses.backward()
         optimizer.step()
 
         if lr_scheduler is not None:
             lr_scheduler.step()
 
-        running_loss += losses
+        running_loss += losses.detach() # Don't keep every step's graph alive
     return running_loss
 
 
 def calculate_map(gt_boxes, pr_boxes, scores, thresh, device, form='pascal_voc'):
+    """
+    Returns the mAP of one sample's predictions at each IoU threshold in
+    `thresh` (a float or 1-D tensor) as a 1-D tensor on `device`.
+    """
     def align_coordinates(boxes):
         """Align coordinates (x1,y1) < (x2,y2) to work with torchvision `box_iou` op
         Arguments:
@@ -196,77 +199,76 @@ def calculate_map(gt_boxes, pr_boxes, scores, thresh, device, form='pascal_voc')
 
 
     def get_mappings(iou_mat):
+        # iou_mat (Tensor[K,N,M]): one thresholded IoU matrix per threshold.
+        # Predictions are matched greedily in score order, for all K
+        # thresholds at once.
         mappings = torch.zeros_like(iou_mat)
-        _, pr_count = iou_mat.shape
-        
-        #first mapping (max iou for first pred_box)
-        if not iou_mat[:,0].eq(0.).all():
-            # if not a zero column
-            mappings[iou_mat[:,0].argsort()[-1],0] = 1
-
-        for pr_idx in range(1,pr_count):
-            # Sum of all the previous mapping columns will let 
-            # us know which gt-boxes are already assigned
-            not_assigned = torch.logical_not(mappings[:,:pr_idx].sum(1)).long()
+        num_thresh, gt_count, pr_count = iou_mat.shape
+        thresh_idxs = torch.arange(num_thresh, device=iou_mat.device)
+        # Which gt-boxes are already assigned, per threshold
+        assigned = torch.zeros(
+            (num_thresh, gt_count), dtype=torch.bool, device=iou_mat.device
+        )
 
+        for pr_idx in range(pr_count):
             # Considering unassigned gt-boxes for further evaluation 
-            targets = not_assigned * iou_mat[:,pr_idx]
-
-            # If no gt-box satisfy the previous conditions
-            # for the current pred-box, ignore it (False Positive)
-            if targets.eq(0).all():
-                continue
-
-            # max-iou from current column after all the filtering
-            # will be the pivot element for mapping
-            pivot = targets.argsort()[-1]
-            mappings[pivot,pr_idx] = 1
+            targets = iou_mat[:, :, pr_idx].masked_fill(assigned, 0.)
+
+            # If no gt-box satisfy the previous conditions for the current
+            # pred-box, ignore it (False Positive); otherwise the max-iou
+            # gt-box is the pivot element for mapping. Ties go to the last
+            # maximal gt-box, as the last element of `argsort()` did.
+            matched = targets.ne(0).any(1)
+            pivot = gt_count - 1 - targets.flip(1).argmax(1)
+            mappings[thresh_idxs, pivot, pr_idx] = matched.to(mappings.dtype)
+            assigned[thresh_idxs, pivot] |= matched
         return mappings
 
 
+    thresh = torch.as_tensor(thresh, dtype=torch.float32, device=device).view(-1)
     if gt_boxes.shape[0] == 0:
         if pr_boxes.shape[0] == 0:
-            return 1.0
-        return 0.0
+            return torch.ones_like(thresh)
+        return torch.zeros_like(thresh)
     if pr_boxes.shape[0] == 0:
-        return 0.0
+        return torch.zeros_like(thresh)
     # sorting
     pr_boxes = pr_boxes[scores.argsort().flip(-1)]
     iou_mat = calculate_iou(gt_boxes,pr_boxes,form)
     iou_mat = iou_mat.to(device)
     
-    # thresholding
-    iou_mat = iou_mat.where(iou_mat > thresh, torch.tensor(0.).to(device))
+    # thresholding, for every threshold in one broadcast
+    iou_mat = iou_mat[None] * (iou_mat[None] > thresh[:, None, None])
     
     mappings = get_mappings(iou_mat)
     
-    # mAP calculation
-    tp = mappings.sum()
-    fp = mappings.sum(0).eq(0).sum()
-    fn = mappings.sum(1).eq(0).sum()
+    # mAP calculation, per threshold
+    tp = mappings.sum((1, 2))
+    fp = mappings.sum(1).eq(0).sum(1)
+    fn = mappings.sum(2).eq(0).sum(1)
     mAP = tp / (tp+fp+fn)
-    return mAP.cpu().detach().numpy()    
+    return mAP    
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def evaluate(model: torch.nn.Module, data_loader, device, thresh_list):
     model.eval()
-    mAP_dict = {thresh: [] for thresh in thresh_list}
+    thresh_list = torch.as_tensor(thresh_list, dtype=torch.float32, device=device)
+    # Summed on the device over samples, one entry per threshold
+    mAP_sum = torch.zeros_like(thresh_list)
+    num_samples: int = 0
     for images, targets in data_loader:
-        images = list(Variable(img).to(device) for img in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        images = list(Variable(img).to(device, non_blocking=True) for img in images)
+        targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
 
         outputs = model(images, targets)
         # Calculate mAP
-        for thresh in thresh_list:
-            mAP_list = [calculate_map(target['boxes'], 
-                                      output['boxes'], 
-                                      output['scores'], 
-                                      thresh=thresh,
-                                      device=device) \
-                        for target, output in zip(targets, outputs)]
-            mAP_dict[thresh] += mAP_list # Creates a list of mAP's for each sample
-    for thresh in thresh_list:
-        mAP_dict[thresh] = np.mean(mAP_dict[thresh])
-    mAP = np.mean(list(mAP_dict.values()))
+        for target, output in zip(targets, outputs):
+            mAP_sum += calculate_map(target['boxes'], 
+                                     output['boxes'], 
+                                     output['scores'], 
+                                     thresh=thresh_list,
+                                     device=device)
+            num_samples += 1
+    mAP = (mAP_sum / max(num_samples, 1)).mean().item()
     return mAP    
@@ -16,19 +16,25 @@ class Metrics(
         return tuple.__new__(cls, [tp, fp, tn, fn, precision, recall, accuracy, F])
 
 
-def calc_metrics(
-    Y: torch.Tensor, Y_hat: torch.Tensor, beta: Optional[float] = 1,
-    eps: Optional[float] = 1e-16
-) -> Dict:
+def confusion_counts(Y: torch.Tensor, Y_hat: torch.Tensor) -> torch.Tensor:
+    """
+    Returns the binary confusion counts `[tp, fp, tn, fn]` of `Y_hat`'s
+    predictions against `Y` as a tensor on their device, so they can be
+    summed over batches without a sync.
+    """
     assert Y.ndim == 1 and Y_hat.ndim == 2, \
         f"Invalid number of dimensions for Y: {Y.ndim} and Y_hat: {Y_hat.ndim}."
 
     Y_pred: torch.Tensor = torch.argmax(Y_hat, dim=1)
+    # Bins: 0 -> tn, 1 -> fp, 2 -> fn, 3 -> tp
+    tn, fp, fn, tp = torch.bincount(2 * Y.long() + Y_pred, minlength=4).unbind()
+    return torch.stack([tp, fp, tn, fn])
+
 
-    tp: int = int(Y_pred @ Y)
-    fp: int = int(Y_pred @ (1 - Y))
-    tn: int = int((1 - Y_pred) @ (1 - Y))
-    fn: int = int((1 - Y_pred) @ Y)
+def metrics_from_counts(
+    counts: torch.Tensor, beta: Optional[float] = 1, eps: Optional[float] = 1e-16
+) -> Dict:
+    tp, fp, tn, fn = counts.tolist()
 
     precision: float = (tp + eps) / (tp + fp + eps)
     recall: float = (tp + eps) / (tp + fn + eps)
@@ -50,3 +56,10 @@ def calc_metrics(
     }
     # metrics = Metrics(tp, fp, tn, fn, precision, recall, accuracy, F_beta)
     return metrics
+
+
+def calc_metrics(
+    Y: torch.Tensor, Y_hat: torch.Tensor, beta: Optional[float] = 1,
+    eps: Optional[float] = 1e-16
+) -> Dict:
+    return metrics_from_counts(confusion_counts(Y, Y_hat), beta=beta, eps=eps)
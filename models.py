@@ -2,15 +2,22 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
 import argparse
+import hashlib
+import logging
 import math
+import os
+from typing import Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
+from torch.fx.experimental.optimization import fuse
 
 from script_utils import arg_is_true, parse_args
 from model_loaders import BACKBONES, fasterrcnn_resnet_fpn
+from transforms import PreNormalize
 
 # BACKBONES = {
 #     "resnet18": models.resnet18,
@@ -20,6 +27,241 @@ from model_loaders import BACKBONES, fasterrcnn_resnet_fpn
 #     "resnet152": models.resnet152
 # }
 
+def compile_model(model: nn.Module, mode: str = "default") -> nn.Module:
+    """
+    Returns `torch.compile(model, mode=mode)` where it is available (PyTorch
+    2.0+) and `model` itself otherwise. The compiled wrapper shares `model`'s
+    parameters; take state dicts from `model`, since the wrapper's keys are
+    prefixed with `_orig_mod.`.
+    """
+    if not hasattr(torch, "compile"):
+        logging.warning(
+            f"torch.compile is not available in PyTorch {torch.__version__}; "
+            "running in eager mode."
+        )
+        return model
+    return torch.compile(model, mode=mode)
+
+
+def fuse_conv_bn(model: nn.Module) -> nn.Module:
+    """
+    For inference only: folds every BatchNorm2d of `model`'s ResNet backbone
+    (if it has one) into the preceding Conv2d, removing a memory-bound pass
+    per layer. The backbone is replaced by a traced copy, so call this after
+    loading the state dict.
+    """
+    if isinstance(getattr(model, "resnet", None), nn.Module):
+        model.resnet = fuse(model.resnet.eval())
+    return model
+
+
+def to_channels_last(x: torch.Tensor) -> torch.Tensor:
+    """
+    Returns `x` in the channels-last (NHWC) memory format, in which cuDNN's
+    fastest convolution kernels run, without changing its shape. Time
+    series (`B x T x C x H x W`) are laid out frame by frame, so that the
+    `(B * T) x C x H x W` view the time-series models pass to their
+    backbones is itself channels-last.
+    """
+    if x.ndim == 5:
+        return x.permute(0, 1, 3, 4, 2).contiguous().permute(0, 1, 4, 2, 3)
+    return x.contiguous(memory_format=torch.channels_last)
+
+
+def frame_features(backbone: nn.Module, x_3d: torch.Tensor) -> torch.Tensor:
+    """
+    Runs `backbone` over every frame of a `B x T x C x H x W` batch and
+    returns the flattened `B x T x F` features. In eval mode all B * T
+    frames go through in one call. In train mode frames are still passed one
+    at a time, so BatchNorm's batch statistics (and running stats) keep
+    being computed over B frames rather than B * T.
+    """
+    batch_size, num_frames = x_3d.shape[:2]
+    if backbone.training:
+        x = torch.stack(
+            [backbone(x_3d[:, t]).flatten(1) for t in range(num_frames)], dim=1
+        )
+    else:
+        x = backbone(x_3d.flatten(0, 1)) # (B * T) x F
+    return x.view(batch_size, num_frames, -1)
+
+
+def check_input_dtype(model: nn.Module, X: torch.Tensor) -> None:
+    """
+    Asserts that uint8 batches only reach models which normalize their own
+    input (those with a `pre_normalize` layer), and that such models aren't
+    fed already-scaled float images.
+    """
+    normalizes_input: bool = getattr(model, "pre_normalize", None) is not None
+    if X.dtype == torch.uint8:
+        assert normalizes_input, \
+            f"Loaded images are uint8, but model {model.__name__} does not " \
+            "normalize its input. Please use a model with a `PreNormalize` " \
+            "layer (e.g. `--pre-normalize True` with 3 channels)."
+    else:
+        assert not normalizes_input, \
+            f"Model {model.__name__} expects uint8 images, but loaded images " \
+            f"are {X.dtype}. Please check that the images are loaded correctly " \
+            "(or pass `--pre-normalize False`, where supported)."
+
+
+class CUDAGraphRunner:
+    """
+    Runs a model's (inference) forward pass by replaying a captured CUDA
+    graph, which removes the per-kernel launch overhead of eager execution.
+    Inputs are copied into a static input tensor before each replay; the
+    graph is recaptured whenever the input shape or dtype changes. Call it
+    under `torch.no_grad()` with CUDA tensors, and only for models which
+    return a single tensor.
+    """
+    NUM_WARMUP_ITERS: int = 3
+
+
+    def __init__(self, model: nn.Module):
+        self.model = model
+        self.graph: Optional[torch.cuda.CUDAGraph] = None
+        self.static_input: Optional[torch.Tensor] = None
+        self.static_output: Optional[torch.Tensor] = None
+
+
+    def capture(self, x: torch.Tensor) -> None:
+        self.static_input = x.clone()
+        # Warm up (e.g. cuDNN autotuning, allocator) on a side stream, as
+        # capture requires
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        # Keeps any enclosing autocast, but without its weight-cast cache:
+        # the graph must own the casts it reads, as the cache is freed when
+        # the enclosing autocast exits
+        autocast = torch.autocast(
+            "cuda", dtype=torch.get_autocast_gpu_dtype(),
+            enabled=torch.is_autocast_enabled(), cache_enabled=False
+        )
+        with torch.cuda.stream(stream), autocast:
+            for _ in range(self.NUM_WARMUP_ITERS):
+                self.model(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), autocast:
+            self.static_output = self.model(self.static_input)
+
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.graph is None or x.shape != self.static_input.shape \
+            or x.dtype != self.static_input.dtype:
+            self.capture(x)
+        else:
+            self.static_input.copy_(x, non_blocking=True)
+        self.graph.replay()
+        return self.static_output.clone() # The next replay overwrites it
+
+
+class ONNXRuntimeRunner:
+    """
+    Runs a model's (inference) forward pass with ONNX Runtime, which fuses
+    operators and picks kernels for the exported graph. With `backend="trt"`
+    the TensorRT execution provider builds an engine instead, cached under
+    `cache_dir`. The model is exported on the first call, keyed by a hash of
+    its state dict so later runs with the same weights reuse both the ONNX
+    file and the engine; the batch dimension is dynamic.
+
+    Requires the `onnxruntime` (or `onnxruntime-gpu`) package. Only for
+    models which take and return a single tensor. Outputs are returned on
+    the CPU.
+    """
+    INPUT_NAME: str = "X"
+    OUTPUT_NAME: str = "Y_hat"
+    OPSET_VERSION: int = 14
+
+
+    def __init__(
+        self, model: nn.Module, cache_dir: str, backend: Optional[str] = "ort",
+        fp16: Optional[bool] = False
+    ):
+        import onnxruntime as ort # Optional dependency
+        self.ort = ort
+        self.model = model
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.fp16 = fp16
+        self.session = None
+
+
+    def state_dict_hash(self) -> str:
+        digest = hashlib.sha1(self.model.__class__.__name__.encode())
+        for key, value in self.model.state_dict().items():
+            digest.update(key.encode())
+            digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()[:16]
+
+
+    def providers(self, device: torch.device) -> list:
+        providers = list()
+        if device.type == "cuda":
+            if self.backend == "trt":
+                providers.append((
+                    "TensorrtExecutionProvider", {
+                        "device_id": device.index or 0,
+                        "trt_fp16_enable": self.fp16,
+                        "trt_engine_cache_enable": True,
+                        "trt_engine_cache_path": self.cache_dir
+                    }
+                ))
+            providers.append(
+                ("CUDAExecutionProvider", {"device_id": device.index or 0})
+            )
+        providers.append("CPUExecutionProvider")
+        available = self.ort.get_available_providers()
+        return [
+            provider for provider in providers
+            if (provider if isinstance(provider, str) else provider[0]) in available
+        ]
+
+
+    def export(self, x: torch.Tensor) -> str:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        onnx_path: str = os.path.join(
+            self.cache_dir, f"{self.model.__class__.__name__}_{self.state_dict_hash()}.onnx"
+        ).replace("\\", "/")
+        if not os.path.exists(onnx_path):
+            logging.info(f"Exporting model to {onnx_path}...")
+            # Traced in full precision outside of inference mode
+            with torch.inference_mode(False), torch.no_grad(), \
+                torch.autocast(x.device.type, enabled=False):
+                torch.onnx.export(
+                    self.model, x.clone(), onnx_path,
+                    input_names=[self.INPUT_NAME], output_names=[self.OUTPUT_NAME],
+                    dynamic_axes={self.INPUT_NAME: {0: "batch"}, self.OUTPUT_NAME: {0: "batch"}},
+                    opset_version=self.OPSET_VERSION
+                )
+        return onnx_path
+
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.session is None:
+            self.session = self.ort.InferenceSession(
+                self.export(x), providers=self.providers(x.device)
+            )
+        if x.is_cuda: # Bound in place, so the input isn't copied back to the host
+            x = x.contiguous()
+            binding = self.session.io_binding()
+            binding.bind_input(
+                name=self.INPUT_NAME, device_type="cuda", device_id=x.device.index or 0,
+                element_type=np.dtype(str(x.dtype).split(".")[-1]), # e.g. torch.uint8 -> uint8
+                shape=tuple(x.shape), buffer_ptr=x.data_ptr()
+            )
+            binding.bind_output(self.OUTPUT_NAME)
+            torch.cuda.current_stream().synchronize() # `x` must be ready
+            self.session.run_with_iobinding(binding)
+            output = binding.copy_outputs_to_cpu()[0]
+        else:
+            output = self.session.run(
+                [self.OUTPUT_NAME], {self.INPUT_NAME: x.numpy()}
+            )[0]
+        return torch.from_numpy(output)
+
+
 class Fire(nn.Module):
     def __init__(
         self, inplanes: int, squeeze_planes: int, expand1x1_planes: int, 
@@ -56,6 +298,7 @@ class SqueezeNet(nn.Module):
     DEFAULT_NUM_CHANNLES: int = 4
     DEFAULT_NUM_CLASSES: int = 10
     DEFAULT_DROPOUT: float = 0.5
+    DEFAULT_PRE_NORMALIZE: bool = True # Only used with 3 (RGB) channels
 
 
     def __init__(self) -> None:
@@ -64,8 +307,14 @@ class SqueezeNet(nn.Module):
         num_channels: int = args["num_channels"]
         num_classes: int = args["num_classes"]
         dropout: float = args["dropout"]
+        pre_normalize: bool = arg_is_true(args["pre_normalize"])
         self.args = args
 
+        # RGB tile datasets and processors hand over uint8 images; EuroSAT
+        # bands arrive as scaled floats and are left as they are
+        self.pre_normalize: Optional[PreNormalize] = PreNormalize() \
+            if pre_normalize and num_channels == 3 else None
+
         self.features = nn.Sequential(
             nn.Conv2d(num_channels, 64, kernel_size=3, stride=2),
             nn.ReLU(inplace=True),
@@ -116,11 +365,17 @@ class SqueezeNet(nn.Module):
             default=self.DEFAULT_DROPOUT,
             type=float
         )
+        parser.add_argument(
+            "--pre-normalize",
+            default=self.DEFAULT_PRE_NORMALIZE
+        )
         args = parse_args(parser=parser)
         return args
 
     
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.pre_normalize is not None:
+            x = self.pre_normalize(x)
         x = self.features(x)
         x = self.classifier(x)
         return torch.flatten(x, 1)
@@ -210,6 +465,7 @@ class ResNetConvLSTM(nn.Module):
 
         self.args = args 
 
+        self.pre_normalize = PreNormalize() # uint8 RGB input -> normalized float
         resnet = BACKBONES[backbone_name](pretrained=True)
         resnet_fc_in_features: int  = resnet.fc.in_features
         resnet.fc = nn.Sequential()
@@ -277,12 +533,11 @@ class ResNetConvLSTM(nn.Module):
 
        
     def forward(self, x_3d):
-        hidden = None
-        for t in range(x_3d.size(1)):
-            with torch.no_grad():
-                x: torch.Tensor = self.resnet(x_3d[:, t, :, :, :])
-                x = x.view(x.size(0), -1) # Flatten output of ResNet
-            out, hidden = self.lstm(x.unsqueeze(0), hidden)         
+        x_3d = self.pre_normalize(x_3d)
+        # The whole sequence goes through the (cuDNN-fused) LSTM in one call
+        with torch.no_grad():
+            x: torch.Tensor = frame_features(self.resnet, x_3d)
+        out, _ = self.lstm(x.transpose(0, 1)) # T x B x F
 
         x = self.fc1(out[-1, :, :])
         x = F.relu(x)
@@ -318,6 +573,7 @@ class ResNet(nn.Module):
 
         self.args = args 
 
+        self.pre_normalize = PreNormalize() # uint8 RGB input -> normalized float
         resnet = BACKBONES[backbone_name](pretrained=True)
         resnet_fc_in_features: int  = resnet.fc.in_features
         resnet.fc = nn.Sequential()
@@ -367,6 +623,7 @@ class ResNet(nn.Module):
 
        
     def forward(self, x):
+        x = self.pre_normalize(x)
         with torch.no_grad():
             x: torch.Tensor = self.resnet(x)
 
@@ -415,6 +672,7 @@ class ResNetOneDConv(nn.Module):
 
         self.args = args 
 
+        self.pre_normalize = PreNormalize() # uint8 RGB input -> normalized float
         resnet = BACKBONES[backbone_name](pretrained=True)
         resnet_fc_in_features: int  = resnet.fc.in_features
         resnet.fc = nn.Sequential()
@@ -493,14 +751,10 @@ class ResNetOneDConv(nn.Module):
 
        
     def forward(self, x_3d):
-        features = list()
-        for t in range(x_3d.size(1)):
-            with torch.no_grad():
-                x: torch.Tensor = self.resnet(x_3d[:, t, :, :, :])
-                x = x.unsqueeze(-1)
-                features.append(x)
-
-        x = torch.concat(features, dim=-1)
+        x_3d = self.pre_normalize(x_3d)
+        with torch.no_grad():
+            x: torch.Tensor = frame_features(self.resnet, x_3d)
+        x = x.transpose(1, 2) # B x F x T
 
         x = self.conv1d(x)
         x = self.maxpool(x)
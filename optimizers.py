@@ -2,12 +2,35 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
 import argparse
+import inspect
 
 import torch
 
 from script_utils import parse_args, arg_is_true
 
 
+def multi_tensor_kwargs(
+    optimizer_class: type, parameters: list, foreach: bool, fused: bool = False
+) -> dict:
+    """
+    Keyword arguments selecting the multi-tensor (`foreach`) or fused
+    implementation of `optimizer_class`'s step, which update all parameters
+    with a few kernel launches instead of one per parameter tensor. Only
+    options the installed PyTorch accepts are returned, and `fused` only
+    when every parameter lives on a CUDA device.
+    """
+    accepted = inspect.signature(optimizer_class.__init__).parameters
+    on_cuda: bool = all(
+        param.is_cuda for group in parameters
+        for param in (group["params"] if isinstance(group, dict) else [group])
+    )
+    if fused and on_cuda and "fused" in accepted:
+        return {"fused": True}
+    if foreach and "foreach" in accepted:
+        return {"foreach": True}
+    return dict()
+
+
 class SGD(torch.optim.SGD):
     __name__: str = "SGD"
 
@@ -15,6 +38,7 @@ class SGD(torch.optim.SGD):
     DEFAULT_MOMENTUM = 0.9
     DEFAULT_NESTEROV = True
     DEFAULT_WEIGHT_DECAY = 5e-4    
+    DEFAULT_FOREACH = True
 
 
     def __init__(self, parameters):
@@ -23,10 +47,13 @@ class SGD(torch.optim.SGD):
         momentum = args["momentum"]
         nesterov = arg_is_true(args["nesterov"])
         weight_decay = args["weight_decay"]           
+        foreach = arg_is_true(args["foreach"])
         self.args = args
+        parameters = list(parameters)
         super().__init__(
             params=parameters, lr=lr, momentum=momentum, 
-            weight_decay=weight_decay, nesterov=nesterov
+            weight_decay=weight_decay, nesterov=nesterov,
+            **multi_tensor_kwargs(torch.optim.SGD, parameters, foreach=foreach)
         )
 
 
@@ -51,6 +78,10 @@ class SGD(torch.optim.SGD):
             default=self.DEFAULT_WEIGHT_DECAY,
             type=float
         )   
+        parser.add_argument(
+            "--foreach",
+            default=self.DEFAULT_FOREACH
+        )
         args = parse_args(parser=parser)
         return args
 
@@ -63,6 +94,8 @@ class Adam(torch.optim.Adam):
     DEFAULT_EPS = 1e-8
     DEFAULT_WEIGHT_DECAY = 0
     DEFAULT_AMSGRAD = False
+    DEFAULT_FOREACH = True
+    DEFAULT_FUSED = True
 
 
     def __init__(self, parameters):
@@ -74,10 +107,16 @@ class Adam(torch.optim.Adam):
         eps = args["eps"]
         weight_decay = args["weight_decay"]
         amsgrad = arg_is_true(args["amsgrad"])
+        foreach = arg_is_true(args["foreach"])
+        fused = arg_is_true(args["fused"])
         self.args = args
+        parameters = list(parameters)
         super().__init__(
             params=parameters, lr=lr, betas=betas, eps=eps, 
-            weight_decay=weight_decay, amsgrad=amsgrad
+            weight_decay=weight_decay, amsgrad=amsgrad,
+            **multi_tensor_kwargs(
+                torch.optim.Adam, parameters, foreach=foreach, fused=fused
+            )
         )
 
 
@@ -108,5 +147,13 @@ class Adam(torch.optim.Adam):
             "--amsgrad",
             default=self.DEFAULT_AMSGRAD
         )
+        parser.add_argument(
+            "--foreach",
+            default=self.DEFAULT_FOREACH
+        )
+        parser.add_argument(
+            "--fused",
+            default=self.DEFAULT_FUSED
+        )
         args = parse_args(parser=parser)
         return args            
@@ -0,0 +1,91 @@
+"""
+Packs every leaf directory of a local imagery tree (one time series, or a
+set of tiles, per directory) into an uncompressed TAR shard, e.g.
+
+    python -m pack_shards --data-dir ../sits/ --shard-dir ../sits_shards/
+
+Members keep their paths relative to `--data-dir`, sorted, and each shard
+records the absolute `--data-dir` in its PAX global header, so predictions
+name the same directories as a run on the original tree. Prediction then
+reads each shard with one sequential read, instead of opening every frame,
+by passing `--from-shards True --data-dir ../sits_shards/` to `predict.py`.
+"""
+
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import argparse
+import logging
+import os
+import tarfile
+import time
+
+from script_utils import get_args
+
+SCRIPT_PATH = os.path.basename(__file__)
+
+DEFAULT_SUFFIXES = [".png", ".jpg", ".jpeg", ".tif", ".tiff"]
+DATA_DIR_HEADER = "zulu.data_dir" # Read back by `Processor.read_shard_as_tensors`
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data-dir",
+        required=True
+    )
+    parser.add_argument(
+        "--shard-dir",
+        required=True
+    )
+    parser.add_argument(
+        "--suffixes",
+        default=DEFAULT_SUFFIXES,
+        nargs="+"
+    )
+    p_args, _ = parser.parse_known_args()
+    return p_args
+
+
+def pack_dir(
+    dirpath: str, filenames: list, data_dir: str, shard_path: str
+) -> None:
+    source_dir: str = os.path.abspath(data_dir).replace("\\", "/")
+    with tarfile.open( # Uncompressed, so members can be sliced
+        shard_path, "w", format=tarfile.PAX_FORMAT,
+        pax_headers={DATA_DIR_HEADER: source_dir}
+    ) as tar:
+        for filename in sorted(filenames):
+            filepath: str = os.path.join(dirpath, filename)
+            arcname: str = os.path.relpath(filepath, data_dir).replace("\\", "/")
+            tar.add(filepath, arcname=arcname, recursive=False)
+
+
+def main():
+    args = get_args(script_path=SCRIPT_PATH, **vars(parse_args()))
+    data_dir: str = args["data_dir"]
+    shard_dir: str = args["shard_dir"]
+    suffixes: tuple = tuple(suffix.lower() for suffix in args["suffixes"])
+    os.makedirs(shard_dir, exist_ok=True)
+
+    start = time.time()
+    num_shards: int = 0
+    for dirpath, dirnames, filenames in sorted(os.walk(data_dir)):
+        if dirnames:
+            continue
+        filenames = [
+            filename for filename in filenames if filename.lower().endswith(suffixes)
+        ]
+        if not filenames:
+            continue
+        shard_path: str = os.path.join(shard_dir, f"{num_shards:08d}.tar")
+        pack_dir(dirpath, filenames, data_dir=data_dir, shard_path=shard_path)
+        num_shards += 1
+    logging.info(
+        f"Packed {num_shards} directories of {data_dir} into {shard_dir} "
+        f"({time.time() - start:.1f}s)."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,25 +8,51 @@ import io
 import json
 import logging
 import os
+import tarfile
 from collections import OrderedDict
-from typing import Generator, List, Optional
+from typing import Generator, List, Optional, Tuple
 
 import aiohttp
 import pandas as pd
 import torch
 import torchvision.transforms as T
+import torchvision.transforms.functional as TF
 from light_pipe import AsyncGatherer, Data, Parallelizer, Transformer
 from PIL import Image, ImageDraw
+from torchvision.io import ImageReadMode, decode_image, read_image
 
 import mercantile
 from detection import bbox_to_geojson
+from pack_shards import DATA_DIR_HEADER
 from script_utils import (arg_is_true, async_tuple_to_args, parse_args,
                           tuple_to_args)
 
 
+def advise_willneed(filepaths: List[str]) -> None:
+    """
+    Asks the kernel to start reading every file in `filepaths` into the page
+    cache in the background, so that cold reads of a sample's files are
+    issued together rather than one at a time. A no-op where
+    `os.posix_fadvise` is unavailable (e.g. Windows, macOS).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for filepath in filepaths:
+        try:
+            fd: int = os.open(filepath, os.O_RDONLY)
+        except OSError: # Left for the decoder to report
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
 class Processor:
     __name__ = "Processor"   
 
+    DRAFT_SIZE: Optional[Tuple[int, int]] = None
+
 
     def sort_filenames(self, filenames: List[str]) -> List[str]:
         filenames_sorted = sorted(filenames)
@@ -58,7 +84,12 @@ class Processor:
 
 
     def read_file_as_pil_image(self, filepath: str) -> Image:
-        img = Image.open(filepath).convert('RGB')
+        img = Image.open(filepath)
+        if self.DRAFT_SIZE is not None:
+            # Lets libjpeg decode JPEGs at a reduced scale (no less than
+            # `DRAFT_SIZE`); a no-op for PNGs
+            img.draft('RGB', self.DRAFT_SIZE)
+        img = img.convert('RGB')
         return img
 
 
@@ -74,6 +105,76 @@ class Processor:
         return images
 
 
+    def read_file_as_tensor(self, filepath: str) -> torch.Tensor:
+        # JPEGs still go through PIL when a draft size is set, so that they
+        # are decoded at reduced scale
+        if self.DRAFT_SIZE is None or filepath.lower().endswith(".png"):
+            try:
+                return read_image(filepath, mode=ImageReadMode.RGB) # C x H x W, uint8
+            except RuntimeError: # A format `torchvision.io` can't decode
+                pass
+        return TF.pil_to_tensor(self.read_file_as_pil_image(filepath))
+
+
+    def read_files_as_tensors(
+        self, filepaths: List[str], return_filepaths: Optional[bool] = False
+    ) -> List[torch.Tensor]:
+        advise_willneed(filepaths)
+        images: List[torch.Tensor] = [
+            self.read_file_as_tensor(filepath) for filepath in filepaths
+        ]
+        if return_filepaths:
+            return images, filepaths
+        return images
+
+
+    @staticmethod
+    def scan_shards(dir_path: str) -> Generator:
+        with os.scandir(dir_path) as it:
+            shard_paths: List[str] = sorted(
+                entry.path for entry in it if entry.name.endswith(".tar")
+            )
+        yield from shard_paths
+
+
+    def read_shard_as_tensors(self, shard_path: str) -> Tuple[List[torch.Tensor], List[str]]:
+        """
+        Decodes every member of a TAR shard written by `pack_shards.py`. The
+        shard is read with one sequential read and members are decoded from
+        zero-copy slices of it. Returns the images (C x H x W, uint8) and
+        the members' original paths (`<packed data dir>/<member name>`), so
+        results name the same directories as a run on the unpacked tree,
+        sorted by member name. Shards without the recorded data dir map
+        members to `<shard dir>/<member name>`.
+        """
+        with open(shard_path, "rb") as f:
+            data = bytearray(f.read())
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+            members: List[tarfile.TarInfo] = sorted(
+                (member for member in tar.getmembers() if member.isfile()), 
+                key=lambda member: member.name
+            )
+            source_dir: str = tar.pax_headers.get(
+                DATA_DIR_HEADER, os.path.dirname(os.path.abspath(shard_path))
+            )
+        images: List[torch.Tensor] = list()
+        filepaths: List[str] = list()
+        for member in members:
+            encoded: torch.Tensor = torch.frombuffer(
+                data, dtype=torch.uint8, offset=member.offset_data, count=member.size
+            )
+            images.append(decode_image(encoded, mode=ImageReadMode.RGB))
+            filepaths.append(os.path.join(source_dir, member.name).replace("\\", "/"))
+        return images, filepaths
+
+
+    @staticmethod
+    def to_tensor(image) -> torch.Tensor:
+        if isinstance(image, torch.Tensor): # Already decoded, C x H x W uint8
+            return image
+        return TF.pil_to_tensor(image)
+
+
 class TimeSeriesProcessor(Processor):
     __name__ = "TimeSeriesProcessor"
 
@@ -198,6 +299,7 @@ class ConvLSTMCProcessor(TimeSeriesProcessor):
     DEFAULT_SAVE_MANIFEST: bool = False
     DEFAULT_SAVE_GEOJSON: bool = False    
     DEFAULT_FROM_LOCAL_FILES: bool = True
+    DEFAULT_FROM_SHARDS: bool = False # Local files packed by `pack_shards.py`
 
     DEFAULT_FROM_PREDS_CSV: bool = False
     DEFAULT_PREDS_CSV_PATH: str = DEFAULT_PRED_MANIFEST    
@@ -209,14 +311,11 @@ class ConvLSTMCProcessor(TimeSeriesProcessor):
 
     NUM_TILES_PER_SUBLIST = 128
     INPUT_SIZE = (224,224)
-    TRANSORMS = T.Compose([
-        T.Resize(INPUT_SIZE),
+    DRAFT_SIZE = INPUT_SIZE
+    TRANSORMS = T.Compose([ # Applied to uint8 tensors (see `to_tensor`)
+        T.Resize(INPUT_SIZE, antialias=True),
         # T.CenterCrop((224,224)),
-        T.ToTensor(),
-        T.Normalize(
-            mean=[0.485, 0.456, 0.406],
-            std=[0.229, 0.224, 0.225]
-        )
+        # Stays uint8; the model converts and normalizes it (`PreNormalize`)
     ])
 
     DEFAULT_START = "2022_01"
@@ -266,6 +365,7 @@ class ConvLSTMCProcessor(TimeSeriesProcessor):
 
         self.save_manifest = save_manifest
         self.from_local_files = from_local_files
+        self.from_shards = arg_is_true(args["from_shards"])
         self.planet_api_key = args["planet_api_key"]
         self.start = args["start"]
         self.end = args["end"]
@@ -308,6 +408,10 @@ class ConvLSTMCProcessor(TimeSeriesProcessor):
             "--from-local-files",
             default=self.DEFAULT_FROM_LOCAL_FILES
         )
+        parser.add_argument(
+            "--from-shards",
+            default=self.DEFAULT_FROM_SHARDS
+        )
         parser.add_argument(
             "--planet-api-key"
         )
@@ -415,16 +519,16 @@ class ConvLSTMCProcessor(TimeSeriesProcessor):
         return images, z, x, y, target_name
 
 
-    def make_sample(self, images: List[Image.Image], *args) -> dict:
-        image_tensors: list = list()
-        for image in images:
-            image: torch.Tensor = self.TRANSORMS(image)
-            image: torch.Tensor = image.float().contiguous()
-            image_tensors.append(image)
-        image_tensors: torch.Tensor = torch.stack(image_tensors, 0)
-        # image_arrays = torch.swapaxes(image_arrays, 1, -1) # _ x W x H x C -> _ x C x H x W
-        # image_arrays = image_arrays[None, :, :, :, :]
-        image_tensors = image_tensors.unsqueeze(0)
+    def make_sample(self, images: list, *args) -> dict: # PIL images or uint8 tensors
+        # Every frame is resized straight into one (pinned, if the model
+        # may run on a GPU) uint8 buffer, so there is no stack copy and the
+        # host-to-device transfer can be asynchronous
+        image_tensors: torch.Tensor = torch.empty(
+            (1, len(images), 3, *self.INPUT_SIZE), dtype=torch.uint8,
+            pin_memory=torch.cuda.is_available()
+        ) # 1 x T x C x H x W
+        for i, image in enumerate(images):
+            image_tensors[0, i].copy_(self.TRANSORMS(self.to_tensor(image)))
 
         return {
             'X': image_tensors,
@@ -563,11 +667,20 @@ class ConvLSTMCProcessor(TimeSeriesProcessor):
         self, dir_path: str, 
         parallelizer: Optional[Parallelizer] = Parallelizer()
     ) -> Generator:
+        if self.from_shards:
+            data = Data(self.scan_shards, dir_path=dir_path)
+            data >> Transformer(self.read_shard_as_tensors, parallelizer=parallelizer) \
+                 >> Transformer(
+                    tuple_to_args(self.make_sample), parallelizer=parallelizer
+                 )
+            yield from data
+            return
+
         data = Data(self.walk_dir, dir_path=dir_path)
 
         data >> Transformer(tuple_to_args(self.get_filepaths), as_list=True) \
              >> Transformer(
-                tuple_to_args(self.read_files_as_pil_image), return_filepaths=True,
+                tuple_to_args(self.read_files_as_tensors), return_filepaths=True,
                 parallelizer=parallelizer
              ) \
              >> Transformer(
@@ -685,10 +798,9 @@ class ResNetProcessor(ConvLSTMCProcessor):
     __name__ = "ResNetProcessor"
 
 
-    def make_sample(self, images: List[Image.Image], *args) -> dict:
+    def make_sample(self, images: list, *args) -> dict: # PIL images or uint8 tensors
         for image in images:
-            image: torch.Tensor = self.TRANSORMS(image)
-            image: torch.Tensor = image.float().contiguous()
+            image: torch.Tensor = self.TRANSORMS(self.to_tensor(image))
             image: torch.Tensor = image.unsqueeze(0)
 
             yield {
@@ -706,10 +818,11 @@ class ObjectDetectorProcessor(ResNetProcessor):
         "Z", "X", "Y", "West", "South", "East", "North", "Geojson Name", "Boxes", "Labels", "Scores"
     ]
     INPUT_SIZE = (224,224)    
-    TRANSORMS = T.Compose([
-        T.Resize(INPUT_SIZE),
+    DRAFT_SIZE = INPUT_SIZE
+    TRANSORMS = T.Compose([ # Applied to uint8 tensors (see `to_tensor`)
+        T.Resize(INPUT_SIZE, antialias=True),
         # T.CenterCrop((224,224)),
-        T.ToTensor(),
+        T.ConvertImageDtype(torch.float32),
         # T.Normalize(
         #     mean=[0.485, 0.456, 0.406],
         #     std=[0.229, 0.224, 0.225]
@@ -721,7 +834,10 @@ class ObjectDetectorProcessor(ResNetProcessor):
     def make_result(output: dict) -> dict:
         result = dict()
         for key, value in output.items():
-            result[key] = value.detach().cpu().numpy().tolist()        
+            value: torch.Tensor = value.detach().cpu()
+            if value.is_floating_point():
+                value = value.float() # e.g. bfloat16 under autocast; NumPy has no bfloat16
+            result[key] = value.numpy().tolist()        
         return result
 
 
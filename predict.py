@@ -6,11 +6,14 @@ import logging
 import os
 import random
 import time
+from typing import Generator, Iterable, List
 
 import torch
 
 from models import (FasterRCNN, ResNet, ResNetConvLSTM, ResNetOneDConv,
-                    SpectrumNet, SqueezeNet)
+                    SpectrumNet, SqueezeNet, CUDAGraphRunner,
+                    ONNXRuntimeRunner, check_input_dtype, compile_model,
+                    fuse_conv_bn, to_channels_last)
 from pred_processors import (ConvLSTMCProcessor, ObjectDetectorProcessor,
                              Processor, ResNetProcessor)
 from script_utils import get_args, get_random_string, arg_is_true
@@ -24,6 +27,24 @@ DEFAULT_DEVICE = "CUDA if available else CPU"
 DEFAULT_CHANNEL_AXIS = 1
 DEFAULT_EXPERIMENT_DIR: str = "experiments/"
 DEFAULT_USE_TIME_STR_EXPERIMENT_DIR: str = True
+DEFAULT_COMPILE = False
+DEFAULT_CUDA_GRAPH = False
+DEFAULT_MIXED_PRECISION = True # Only used on CUDA
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_FUSE_CONV_BN = True
+DEFAULT_AMP_DTYPE = "bfloat16"
+DEFAULT_BACKEND = "pytorch"
+DEFAULT_CHANNELS_LAST = True # Only used on CUDA
+DEFAULT_ONNX_CACHE_DIR = "onnx_cache/"
+
+# "ort" runs the exported model with ONNX Runtime; "trt" with its TensorRT
+# execution provider
+BACKENDS = ["pytorch", "ort", "trt"]
+
+AMP_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16
+}
 
 DEFAULT_SEED = 8675309 # (___)-867-5309
 
@@ -86,10 +107,80 @@ def parse_args():
         "--use-time-str-experiment-dir",
         default=DEFAULT_USE_TIME_STR_EXPERIMENT_DIR
     )
+    parser.add_argument(
+        "--compile",
+        default=DEFAULT_COMPILE
+    )
+    parser.add_argument(
+        "--cuda-graph",
+        default=DEFAULT_CUDA_GRAPH
+    )
+    parser.add_argument(
+        "--mixed-precision",
+        default=DEFAULT_MIXED_PRECISION
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=DEFAULT_BATCH_SIZE,
+        type=int
+    )
+    parser.add_argument(
+        "--fuse-conv-bn",
+        default=DEFAULT_FUSE_CONV_BN
+    )
+    parser.add_argument(
+        "--amp-dtype",
+        default=DEFAULT_AMP_DTYPE,
+        choices=list(AMP_DTYPES)
+    )
+    parser.add_argument(
+        "--channels-last",
+        default=DEFAULT_CHANNELS_LAST
+    )
+    parser.add_argument(
+        "--backend",
+        default=DEFAULT_BACKEND,
+        choices=BACKENDS
+    )
+    parser.add_argument(
+        "--onnx-cache-dir",
+        default=DEFAULT_ONNX_CACHE_DIR
+    )
     p_args, _ = parser.parse_known_args()
     return p_args
 
 
+def batch_samples(
+    samples: Iterable[dict], batch_size: int
+) -> Generator[List[dict], None, None]:
+    """
+    Groups consecutive samples into lists of at most `batch_size`. A batch is
+    cut short whenever the next sample's shape differs (e.g. a time series
+    with a different number of frames), so every batch can be concatenated.
+    """
+    batch: List[dict] = list()
+    for sample in samples:
+        if batch and sample["X"].shape != batch[0]["X"].shape:
+            yield batch
+            batch = list()
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def concat_samples(batch: List[dict], pin_memory: bool) -> torch.Tensor:
+    if len(batch) == 1:
+        return batch[0]["X"]
+    first: torch.Tensor = batch[0]["X"] # 1 x ...
+    X: torch.Tensor = torch.empty(
+        (len(batch), *first.shape[1:]), dtype=first.dtype, pin_memory=pin_memory
+    )
+    return torch.cat([sample["X"] for sample in batch], out=X)
+
+
 def main():
     args = vars(parse_args())
 
@@ -158,6 +249,14 @@ def main():
     )
 
     logging.info(f'Using device {device}')
+
+    use_mp: bool = arg_is_true(args["mixed_precision"]) and device.type == "cuda"
+    amp_dtype: torch.dtype = AMP_DTYPES[args["amp_dtype"]]
+    if use_mp and amp_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        logging.info("This GPU does not support bfloat16; using float16 instead.")
+        amp_dtype = torch.float16
+    if use_mp:
+        logging.info(f"Using mixed precision ({amp_dtype})")
     logging.info(f'Model loaded from {model_filepath}')     
 
     data_dir = args["data_dir"]
@@ -166,22 +265,68 @@ def main():
     samples = pred_processor.make_samples(dir_path=data_dir)
 
     model.eval()
+    if arg_is_true(args["fuse_conv_bn"]):
+        model = fuse_conv_bn(model)
+    # After fusing, which recomputes the conv weights. NHWC convolutions are
+    # cuDNN's fastest; inputs are converted to match.
+    use_channels_last: bool = arg_is_true(args["channels_last"]) \
+        and device.type == "cuda" and args["backend"] == "pytorch" \
+        and not model.IS_OBJECT_DETECTOR
+    if use_channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    # The first sample triggers compilation. CUDA graphs ("reduce-overhead")
+    # cut per-kernel launch overhead, as sample shapes are fixed. Detection
+    # models take variable-size lists, so they stay eager.
+    backend: str = args["backend"]
+    # Captured graphs read the weights' low-precision casts directly, so
+    # autocast must not cache them (the cache is freed after each batch)
+    uses_cuda_graphs: bool = False
+    if backend != "pytorch" and not model.IS_OBJECT_DETECTOR:
+        # Exported on the first sample. With "trt", `--mixed-precision` lets
+        # TensorRT build float16 kernels.
+        forward_model = ONNXRuntimeRunner(
+            model, cache_dir=args["onnx_cache_dir"], backend=backend, fp16=use_mp
+        )
+    elif arg_is_true(args["compile"]) and not model.IS_OBJECT_DETECTOR:
+        forward_model: torch.nn.Module = compile_model(
+            model, mode="reduce-overhead" if device.type == "cuda" else "default"
+        )
+        uses_cuda_graphs = device.type == "cuda"
+    elif arg_is_true(args["cuda_graph"]) and device.type == "cuda" \
+        and not model.IS_OBJECT_DETECTOR:
+        forward_model = CUDAGraphRunner(model) # Captured on the first sample
+        uses_cuda_graphs = True
+    else:
+        forward_model = model
+    batch_size: int = args["batch_size"]
     sample_idx: int = 0
-    for sample in samples:
-        sample_idx += 1
-        X: torch.Tensor = sample["X"]
-        X: torch.Tensor = X.to(device=device, dtype=torch.float32)
+    for batch in batch_samples(samples, batch_size=batch_size):
+        X: torch.Tensor = concat_samples(batch, pin_memory=device.type == "cuda")
+        X: torch.Tensor = X.to(device=device, non_blocking=True) # uint8 images are converted to float on the device
+        if use_channels_last:
+            X = to_channels_last(X)
         X_num_channels = X.shape[channel_axis]
         assert X_num_channels == model_num_channels, \
             f"Network has been defined with {model_num_channels}" \
             f"input channels, but loaded images have {X_num_channels}" \
             "channels. Please check that the images are loaded correctly."        
-        logging.info(f"Generating predictions for sample {sample_idx}...")
-        with torch.no_grad():
-            pred = model(X)
-        logging.info(f"Saving predictions for sample {sample_idx}...")
-        pred_processor.save_results(input=sample, output=pred)
-        # save_preds(input=sample, output=pred)    
+        if not model.IS_OBJECT_DETECTOR:
+            check_input_dtype(model, X)
+        logging.info(
+            f"Generating predictions for samples {sample_idx + 1}-{sample_idx + len(batch)}..."
+        )
+        with torch.inference_mode(), torch.autocast(
+            device.type, dtype=amp_dtype, enabled=use_mp,
+            cache_enabled=not uses_cuda_graphs
+        ):
+            pred = forward_model(X)
+        for i, sample in enumerate(batch):
+            sample_idx += 1
+            logging.info(f"Saving predictions for sample {sample_idx}...")
+            # Sliced so each sample's output keeps its batch dimension (or,
+            # for detection models, stays a one-element list)
+            pred_processor.save_results(input=sample, output=pred[i:i + 1])
+            # save_preds(input=sample, output=pred)    
     logging.info(
         """
                 ================
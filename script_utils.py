@@ -4,6 +4,7 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 import argparse
 import hashlib
 import logging
+import logging.handlers
 import functools
 import os
 import random
@@ -15,6 +16,7 @@ SCRIPT_PATH = os.path.basename(__file__)
 DEFAULT_LOGGING = "INFO"
 DEFAULT_TIME_STR = time.strftime("%Y%m%d_%H%M%S", time.gmtime())
 DEFAULT_LOG_DIR = 'logs'
+DEFAULT_LOG_BUFFER_CAPACITY = 256 # Records held before writing the log file; 0 writes each one
 
 SECRET_KEY = 'f39sj)3j09ja0e8f1as98u!98auf-b23bacxmza9820h35m./9'
 
@@ -131,6 +133,11 @@ def get_args(
         help="Path to a local file to which log messages will be written.",
         type=str
     )
+    parser.add_argument(
+        "--log-buffer-capacity",
+        default=DEFAULT_LOG_BUFFER_CAPACITY,
+        type=int
+    )
     p_args, _ = parser.parse_known_args()
     p_args = vars(p_args)
 
@@ -155,7 +162,16 @@ def get_args(
 
         fileHandler = logging.FileHandler(log_filepath)
         fileHandler.setFormatter(logFormatter)
-        rootLogger.addHandler(fileHandler)
+        log_buffer_capacity: int = p_args['log_buffer_capacity']
+        if log_buffer_capacity > 0:
+            # Records are written in batches; errors, and exiting, flush them
+            rootLogger.addHandler(
+                logging.handlers.MemoryHandler(
+                    capacity=log_buffer_capacity, target=fileHandler
+                )
+            )
+        else:
+            rootLogger.addHandler(fileHandler)
 
         consoleHandler = logging.StreamHandler()
         consoleHandler.setFormatter(logFormatter)
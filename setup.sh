@@ -28,6 +28,12 @@ conda create --name $CONDAENV --file $SETUPFILE
 conda run -n $CONDAENV pip3 install light-pipe \
     && pip3 install Pillow \
     && pip3 install aiohttp
+# Pillow-SIMD is a faster drop-in replacement for Pillow (needs a compiler):
+# conda run -n $CONDAENV pip3 uninstall -y Pillow \
+#     && CC="cc -mavx2" pip3 install -U --force-reinstall pillow-simd
+# ONNX Runtime is only needed for `predict.py --backend ort` (or `trt`, which
+# also needs TensorRT):
+# conda run -n $CONDAENV pip3 install onnxruntime-gpu
 
 ### GCloud Setup
 # gcloud init --no-browser    
\ No newline at end of file
@@ -2,6 +2,7 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
 import argparse
+import contextlib
 import logging
 import os
 import random
@@ -10,13 +11,14 @@ import time
 import numpy as np
 import torch
 
-from datasets import (ConvLSTMCDataset, EurosatDataset,
-                      XYZObjectDetectionDataset, XYZObjectDetectionDatasetTwo,
-                      XYZTileDataset)
+from datasets import (ConvLSTMCDataset, CUDAPrefetcher, EurosatDataset,
+                      ThreadPoolLoader, XYZObjectDetectionDataset,
+                      XYZObjectDetectionDatasetTwo, XYZTileDataset)
 from detection import collate_fn, evaluate, train_one_epoch
-from metrics import calc_metrics
+from metrics import confusion_counts, metrics_from_counts
 from models import (FasterRCNN, ResNet, ResNetConvLSTM, ResNetOneDConv,
-                    SpectrumNet, SqueezeNet)
+                    SpectrumNet, SqueezeNet, check_input_dtype, compile_model,
+                    to_channels_last)
 from optimizers import SGD, Adam
 from schedulers import ReduceLROnPlateau, StepLR
 from script_utils import arg_is_false, arg_is_true, get_args, get_random_string
@@ -37,9 +39,14 @@ DEFAULT_CRITERION_NAME = "CrossEntropyLoss"
 DEFAULT_USE_CLASS_WEIGHTS = False
 DEFAULT_EXPERIMENT_DIR = "experiments/"
 DEFAULT_NUM_WORKERS = os.cpu_count()
+DEFAULT_LOADER_THREADS = 0 # If > 0, load in threads instead of worker processes
+DEFAULT_PREFETCH_FACTOR = 4 # Batches loaded ahead by each worker process
 DEFAULT_PIN_MEMORY = True
+DEFAULT_CUDA_PREFETCH = True # Copy the next batch to the GPU on a side stream
+DEFAULT_CHANNELS_LAST = True # Only used on CUDA
 DEFAULT_DEVICE = "CUDA if available else CPU"
 DEFAULT_MIXED_PRECISION = True
+DEFAULT_COMPILE = False
 DEFAULT_SAVE_MODEL = True
 DEFAULT_SAVE_EVERY = 8
 DEFAULT_CHANNEL_AXIS = 1
@@ -49,7 +56,7 @@ DEFAULT_SAVE_LOSSES = True
 DEFAULT_VALIDATION = True
 DEFAULT_PRINT_VAL_PREDS = False
 DEFAULT_PRINT_METRICS = True
-DEFAULT_THRESH_LIST = np.arange(0.5, 0.95, 0.05).round(8) # COCO AP@[.5:.95]
+DEFAULT_THRESH_LIST = torch.tensor(np.arange(0.5, 0.95, 0.05).round(8)) # COCO AP@[.5:.95]; moved to the device in `evaluate`
 
 DEFAULT_SEED = 8675309 # (___)-867-5309
 
@@ -154,10 +161,28 @@ def parse_args():
         default=DEFAULT_NUM_WORKERS,
         type=int
     )  
+    parser.add_argument(
+        "--prefetch-factor",
+        default=DEFAULT_PREFETCH_FACTOR,
+        type=int
+    )
+    parser.add_argument(
+        "--loader-threads",
+        default=DEFAULT_LOADER_THREADS,
+        type=int
+    )
     parser.add_argument(
         "--pin-memory",
         default=DEFAULT_PIN_MEMORY
     )       
+    parser.add_argument(
+        "--cuda-prefetch",
+        default=DEFAULT_CUDA_PREFETCH
+    )
+    parser.add_argument(
+        "--channels-last",
+        default=DEFAULT_CHANNELS_LAST
+    )
     parser.add_argument(
         '--device',
         default=DEFAULT_DEVICE
@@ -166,6 +191,10 @@ def parse_args():
         "--mixed-precision",
         default=DEFAULT_MIXED_PRECISION
     )
+    parser.add_argument(
+        "--compile",
+        default=DEFAULT_COMPILE
+    )
     parser.add_argument(
         "--save-model",
         default=DEFAULT_SAVE_MODEL
@@ -207,6 +236,40 @@ def parse_args():
     return p_args    
 
 
+def get_data_loader(
+    dataset: torch.utils.data.Dataset, shuffle: bool, batch_size: int, 
+    num_workers: int, pin_memory: bool, loader_threads: int, collate_fn=None,
+    generator: torch.Generator = None, 
+    prefetch_factor: int = DEFAULT_PREFETCH_FACTOR
+):
+    if loader_threads > 0:
+        return ThreadPoolLoader(
+            dataset, shuffle=shuffle, batch_size=batch_size, 
+            num_threads=loader_threads, pin_memory=pin_memory, 
+            collate_fn=collate_fn, generator=generator
+        )
+    # Worker processes are kept alive between epochs instead of respawned;
+    # both options are only accepted when there are workers
+    worker_kwargs = dict(
+        persistent_workers=True, prefetch_factor=prefetch_factor
+    ) if num_workers > 0 else dict()
+    return torch.utils.data.DataLoader(
+        dataset, shuffle=shuffle, batch_size=batch_size, 
+        num_workers=num_workers, pin_memory=pin_memory, collate_fn=collate_fn,
+        generator=generator, **worker_kwargs
+    )
+
+
+def check_num_channels(
+    X: torch.Tensor, channel_axis: int, model_num_channels: int
+) -> None:
+    X_num_channels = X.shape[channel_axis]
+    assert X_num_channels == model_num_channels, \
+        f"Network has been defined with {model_num_channels} " \
+        f"input channels, but loaded images have {X_num_channels} " \
+        "channels. Please check that the images are loaded correctly."
+
+
 def main():
     args = vars(parse_args())
 
@@ -260,6 +323,11 @@ def main():
     model_filepath = args["model_filepath"]   
 
     model = model.to(device=device)  
+    # NHWC convolutions are cuDNN's fastest; inputs are converted to match
+    use_channels_last: bool = arg_is_true(args["channels_last"]) \
+        and device.type == "cuda" and not model.IS_OBJECT_DETECTOR
+    if use_channels_last:
+        model = model.to(memory_format=torch.channels_last)
     model_num_channels = model.args["num_channels"] # A constraint on the Model class        
 
     num_epochs = args["num_epochs"]
@@ -268,6 +336,10 @@ def main():
     dataset_name = args["dataset"]
     dataset = DATASETS[dataset_name]()
 
+    batch_transforms = dataset.batch_transforms # A constraint on the Dataset class
+    if batch_transforms is not None:
+        batch_transforms = batch_transforms.to(device=device)
+
     validation = arg_is_true(args["validation"])
     print_val_preds: bool = arg_is_true(args["print_val_preds"])
     print_metrics: bool = arg_is_true(args["print_metrics"])
@@ -288,29 +360,27 @@ def main():
     shuffle = arg_is_true(args["shuffle"])
     num_workers = args["num_workers"]
     pin_memory = arg_is_true(args["pin_memory"])
-    if model.IS_OBJECT_DETECTOR:
-        train_loader = torch.utils.data.DataLoader(
-            train_set, shuffle=shuffle, batch_size=batch_size, 
-            num_workers=num_workers, pin_memory=pin_memory,
-            collate_fn=collate_fn
-        )
-    else:
-        train_loader = torch.utils.data.DataLoader(
-            train_set, shuffle=shuffle, batch_size=batch_size, 
-            num_workers=num_workers, pin_memory=pin_memory,
-        )        
+    loader_threads = args["loader_threads"]
+    prefetch_factor = args["prefetch_factor"]
+    loader_collate_fn = collate_fn if model.IS_OBJECT_DETECTOR else None
+    train_loader = get_data_loader(
+        train_set, shuffle=shuffle, batch_size=batch_size, 
+        num_workers=num_workers, pin_memory=pin_memory, 
+        loader_threads=loader_threads, collate_fn=loader_collate_fn,
+        generator=torch.Generator().manual_seed(seed), # Reproducible shuffling
+        prefetch_factor=prefetch_factor
+    )
     if validation:
-        if model.IS_OBJECT_DETECTOR:
-            validation_loader = torch.utils.data.DataLoader(
-                validation_set, shuffle=False, batch_size=batch_size, 
-                num_workers=num_workers, pin_memory=pin_memory,
-                collate_fn=collate_fn
-            )                
-        else:
-            validation_loader = torch.utils.data.DataLoader(
-                validation_set, shuffle=False, batch_size=batch_size, 
-                num_workers=num_workers, pin_memory=pin_memory
-            )    
+        validation_loader = get_data_loader(
+            validation_set, shuffle=False, batch_size=batch_size, 
+            num_workers=num_workers, pin_memory=pin_memory, 
+            loader_threads=loader_threads, collate_fn=loader_collate_fn,
+            prefetch_factor=prefetch_factor
+        )
+    if arg_is_true(args["cuda_prefetch"]) and device.type == "cuda":
+        train_loader = CUDAPrefetcher(train_loader, device=device)
+        if validation:
+            validation_loader = CUDAPrefetcher(validation_loader, device=device)
 
     optimizer_name = args["optimizer"]
     Optimizer = OPTIMIZERS[optimizer_name]      
@@ -349,6 +419,13 @@ def main():
 
     use_mp = arg_is_true(args["mixed_precision"])
 
+    # Forward passes go through `forward_model`; `model` is still what gets
+    # saved. Detection models take variable-size lists, so they stay eager.
+    if arg_is_true(args["compile"]) and not model.IS_OBJECT_DETECTOR:
+        forward_model: torch.nn.Module = compile_model(model)
+    else:
+        forward_model = model
+
     use_class_weights = arg_is_true(args["use_class_weights"])
     if use_class_weights:
         weight = dataset.class_weights
@@ -365,131 +442,150 @@ def main():
     save_every = args["save_every"]
 
     channel_axis = args["channel_axis"]
+    # Every batch comes from the same dataset, so the first one is checked
+    channels_checked: bool = False
 
-    ### Train Loop Begins ###
-    logging.info("Starting training...")
-    for epoch in range(1, num_epochs + 1):
-        logging.info(f"Starting epoch {epoch}...")
-        if model.IS_OBJECT_DETECTOR:
-            train_loss = train_one_epoch(
-                model=model, optimizer=optimizer, data_loader=train_loader, 
-                device=device, lr_scheduler=None
+    # Reused by every forward pass
+    autocast = torch.autocast(
+        device.type if device.type != "mps" else "cpu", enabled=use_mp
+    )
+
+    # Both loss files are closed however training exits; line-buffered, so
+    # each epoch's loss is written as soon as it is known
+    with contextlib.ExitStack() as loss_files:
+        if save_losses:
+            train_loss_file = loss_files.enter_context(
+                open(train_loss_path, "a", buffering=1)
             )
-            train_loss = float(train_loss)   
-        else:
-            model.train()
-            train_loss = 0.0            
-            for batch in train_loader:
-                X, Y = batch["X"], batch["Y"] # A constraint on the Dataset class
-                X_num_channels = X.shape[channel_axis]
-                assert X_num_channels == model_num_channels, \
-                    f"Network has been defined with {model_num_channels}" \
-                    f"input channels, but loaded images have {X_num_channels}" \
-                    "channels. Please check that the images are loaded correctly."
-                
-                # logging.info(f"X size: {X.shape}")
-                # logging.info(f"Y size: {Y.shape}")
-                X = X.to(device=device, dtype=torch.float32) # A constraint on the Dataset class
-                Y = Y.to(device=device, dtype=torch.long) # A constraint on the Dataset class
-                optimizer.zero_grad()
-                with torch.autocast(
-                    device.type if device.type != "mps" else "cpu", enabled=use_mp 
-                ):
-                    Y_hat = model(X)
-                    loss = criterion(Y_hat, Y)
-                train_loss += loss.item()
-                loss.backward()
-                optimizer.step()
-
-        logging.info(
-            f"""
-                    Epoch {epoch} training completed.
-                    Train loss: {train_loss:.5f}.\
-        
-                    Starting validation...
-            """
-        )
-        validation_loss = 0.0
-        if validation:
+            validation_loss_file = loss_files.enter_context(
+                open(validation_loss_path, "a", buffering=1)
+            )
+
+        ### Train Loop Begins ###
+        logging.info("Starting training...")
+        for epoch in range(1, num_epochs + 1):
+            logging.info(f"Starting epoch {epoch}...")
             if model.IS_OBJECT_DETECTOR:
-                mAP = evaluate(
-                    model=model, data_loader=validation_loader, device=device, 
-                    thresh_list=DEFAULT_THRESH_LIST
+                train_loss = train_one_epoch(
+                    model=model, optimizer=optimizer, data_loader=train_loader, 
+                    device=device, lr_scheduler=None
                 )
-                metrics = {"mAP": float(mAP)}
-                if print_metrics:
-                    for key, value in metrics.items():
-                        logging.info(f"{key}: {value}")                
+                train_loss = float(train_loss)   
             else:
-                model.eval()
-                for batch in validation_loader:
+                model.train()
+                # Accumulated on the device, so the loop never waits on the GPU
+                train_loss_sum = torch.zeros((), device=device)
+                for batch in train_loader:
                     X, Y = batch["X"], batch["Y"] # A constraint on the Dataset class
-                    X_num_channels = X.shape[channel_axis]
-                    assert X_num_channels == model_num_channels, \
-                        f"Network has been defined with {model_num_channels} " \
-                        f"input channels, but loaded images have {X_num_channels} " \
-                        "channels. Please check that the images are loaded correctly."
-                    
-                    X = X.to(device=device, dtype=torch.float32) # A constraint on the Dataset class
-                    Y = Y.to(device=device, dtype=torch.long) # A constraint on the Dataset class
-                    with torch.autocast(
-                        device.type if device.type != "mps" else "cpu", enabled=use_mp 
-                    ):
-                        with torch.no_grad():
-                            Y_hat = model(X)
+                    if not channels_checked:
+                        check_num_channels(X, channel_axis, model_num_channels)
+                        check_input_dtype(model, X)
+                        channels_checked = True
+                
+                    # logging.info(f"X size: {X.shape}")
+                    # logging.info(f"Y size: {Y.shape}")
+                    X = X.to(device=device, non_blocking=True) # uint8 images are converted to float on the device
+                    Y = Y.to(device=device, dtype=torch.long, non_blocking=True) # A constraint on the Dataset class
+                    if batch_transforms is not None:
+                        X = batch_transforms(X)
+                    if use_channels_last:
+                        X = to_channels_last(X)
+                    optimizer.zero_grad(set_to_none=True)
+                    with autocast:
+                        Y_hat = forward_model(X)
                         loss = criterion(Y_hat, Y)
-                    validation_loss += loss.item()
-
-                    Y = Y.cpu()
-                    Y_hat = Y_hat.cpu()
-
-
-                    metrics: dict = calc_metrics(Y, Y_hat, beta=F_beta)
+                    train_loss_sum += loss.detach()
+                    loss.backward()
+                    optimizer.step()
+                train_loss = train_loss_sum.item()
+
+            logging.info(
+                f"""
+                        Epoch {epoch} training completed.
+                        Train loss: {train_loss:.5f}.\
+        
+                        Starting validation...
+                """
+            )
+            validation_loss = 0.0
+            if validation:
+                if model.IS_OBJECT_DETECTOR:
+                    mAP = evaluate(
+                        model=model, data_loader=validation_loader, device=device, 
+                        thresh_list=DEFAULT_THRESH_LIST
+                    )
+                    metrics = {"mAP": float(mAP)}
+                    if print_metrics:
+                        for key, value in metrics.items():
+                            logging.info(f"{key}: {value}")                
+                else:
+                    model.eval()
+                    validation_loss_sum = torch.zeros((), device=device)
+                    # Confusion counts are summed on the device too, so metrics
+                    # cover the whole validation set and sync once per epoch
+                    counts_sum = torch.zeros(4, dtype=torch.long, device=device)
+                    for batch in validation_loader:
+                        X, Y = batch["X"], batch["Y"] # A constraint on the Dataset class
+                        if not channels_checked:
+                            check_num_channels(X, channel_axis, model_num_channels)
+                            check_input_dtype(model, X)
+                            channels_checked = True
+                    
+                        X = X.to(device=device, non_blocking=True) # uint8 images are converted to float on the device
+                        Y = Y.to(device=device, dtype=torch.long, non_blocking=True) # A constraint on the Dataset class
+                        if use_channels_last:
+                            X = to_channels_last(X)
+                        with torch.inference_mode(), autocast:
+                            Y_hat = forward_model(X)
+                            loss = criterion(Y_hat, Y)
+                        validation_loss_sum += loss
+                        counts_sum += confusion_counts(Y, Y_hat)
+
+                        if print_val_preds:
+                            logging.info(
+                                f"""
+                                Validation batch:
+
+                                Target:
+                                    {Y.cpu().unsqueeze(-1)}
+
+                                Predictions:
+                                    {Y_hat.cpu()}
+                                """
+                            )
+                    validation_loss = validation_loss_sum.item()
+
+                    metrics: dict = metrics_from_counts(counts_sum, beta=F_beta)
                     metrics["validation_loss"] = validation_loss
                     if print_metrics:
                         for key, value in metrics.items():
                             logging.info(f"{key}: {value}")
 
-                    if print_val_preds:
-                        logging.info(
-                            f"""
-                            Validation batch:
-
-                            Target:
-                                {Y.unsqueeze(-1)}
+            if use_scheduler:
+                if scheduler.requires_metrics:
+                    scheduler.step(metrics[scheduler_metric])
+                else:
+                    scheduler.step()
 
-                            Predictions:
-                                {Y_hat}
-                            """
-                        )
+            logging.info(
+                f"""
 
-        if use_scheduler:
-            if scheduler.requires_metrics:
-                scheduler.step(metrics[scheduler_metric])
-            else:
-                scheduler.step()
-
-        logging.info(
-            f"""
-
-                    Epoch {epoch} completed.
-                    Train loss: {train_loss:.5f}.
-                    Validation loss: {validation_loss:.5f}.
+                        Epoch {epoch} completed.
+                        Train loss: {train_loss:.5f}.
+                        Validation loss: {validation_loss:.5f}.
         
-            """
-        )
+                """
+            )
         
-        if save_losses:
-            with open(train_loss_path, "a") as tp:
-                tp.write(str(train_loss) + "\n")
-            with open(validation_loss_path, "a") as vp:
-                vp.write(str(validation_loss) + "\n")
-
-        if (save_model and epoch % save_every == 0) or epoch == num_epochs:
-            state_dict = model.state_dict()
-            savepath = os.path.join(save_dir, f"checkpoint_epoch_{epoch:04}.pth")
-            torch.save(state_dict, savepath)
-            logging.info(f"Checkpoint {epoch} saved.")
+            if save_losses:
+                train_loss_file.write(str(train_loss) + "\n")
+                validation_loss_file.write(str(validation_loss) + "\n")
+
+            if (save_model and epoch % save_every == 0) or epoch == num_epochs:
+                state_dict = model.state_dict()
+                savepath = os.path.join(save_dir, f"checkpoint_epoch_{epoch:04}.pth")
+                torch.save(state_dict, savepath)
+                logging.info(f"Checkpoint {epoch} saved.")
     logging.info(
         """
                 ================
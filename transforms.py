@@ -0,0 +1,123 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import math
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+IMAGENET_MEAN: List[float] = [0.485, 0.456, 0.406]
+IMAGENET_STD: List[float] = [0.229, 0.224, 0.225]
+
+
+class BatchAugmentation(nn.Module):
+    """
+    Random flips and rotations applied to a whole (collated) batch, ideally
+    after it has been moved to the GPU. Accepts `B x C x H x W` batches or, if
+    `time_series` is set, `B x T x C x H x W` batches in which every frame of
+    a sample receives the same transformation.
+
+    Each sample's flips and rotation are composed into a single affine matrix,
+    so the batch is resampled with one `grid_sample` call no matter how many
+    of the transformations a sample receives.
+    """
+    __name__ = "BatchAugmentation"
+
+    DEFAULT_P: float = 0.25
+    DEFAULT_MAX_ANGLE: int = 30
+
+
+    def __init__(
+        self, p: Optional[float] = DEFAULT_P,
+        max_angle: Optional[int] = DEFAULT_MAX_ANGLE,
+        use_rotation: Optional[bool] = True,
+        time_series: Optional[bool] = False
+    ):
+        super().__init__()
+        self.p = p
+        self.max_angle = max_angle
+        self.use_rotation = use_rotation
+        self.time_series = time_series
+
+
+    def make_theta(
+        self, batch_size: int, height: int, width: int, device: torch.device,
+        dtype: torch.dtype
+    ) -> torch.Tensor:
+        # One draw decides, per sample, whether to apply each of the
+        # horizontal flip, vertical flip and rotation
+        apply = torch.rand((batch_size, 3), device=device) < self.p
+        flip_x, flip_y = (1 - 2 * apply[:, :2].to(dtype)).unbind(1) # -1 flips
+        if self.use_rotation:
+            angle = (torch.rand(batch_size, device=device, dtype=dtype) * 2 - 1) \
+                * math.radians(self.max_angle) * apply[:, 2]
+        else:
+            angle = torch.zeros(batch_size, device=device, dtype=dtype)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # Rotation (corrected for aspect ratio in normalized coordinates)
+        # composed with the flips; maps output coordinates to input ones
+        theta = torch.zeros((batch_size, 2, 3), device=device, dtype=dtype)
+        theta[:, 0, 0] = cos * flip_x
+        theta[:, 0, 1] = -sin * (height / width) * flip_y
+        theta[:, 1, 0] = sin * (width / height) * flip_x
+        theta[:, 1, 1] = cos * flip_y
+        return theta
+
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not x.is_floating_point(): # e.g. uint8 batches; values stay in [0, 255]
+            x = x.to(torch.float32)
+        shape = x.shape
+        if self.time_series:
+            batch_size, num_frames = shape[:2]
+            x = x.reshape(-1, *shape[2:]) # (B * T) x C x H x W
+        else:
+            batch_size, num_frames = shape[0], 1
+        height, width = shape[-2:]
+        theta: torch.Tensor = self.make_theta(
+            batch_size, height, width, device=x.device, dtype=x.dtype
+        )
+        theta = theta.repeat_interleave(num_frames, dim=0)
+        grid = F.affine_grid(theta, x.shape, align_corners=False)
+        x = F.grid_sample(x, grid, mode="bilinear", align_corners=False)
+        return x.reshape(shape)
+
+
+class PreNormalize(nn.Module):
+    """
+    First layer of the models trained on uint8 RGB images. Converts the input
+    to float32 and applies channel-wise normalization in one pass, with the
+    `/ 255` of the dtype conversion folded into the precomputed constants, so
+    datasets and processors can hand over raw uint8 tensors (a quarter of the
+    bytes of float32) and the conversion runs on the model's device.
+
+    Float inputs (e.g. batches resampled by `BatchAugmentation`) are expected
+    to still be in `[0, 255]`; they are not modified in place. The buffers are
+    not persistent, so existing checkpoints load unchanged.
+    """
+    __name__ = "PreNormalize"
+
+
+    def __init__(
+        self, mean: Optional[List[float]] = IMAGENET_MEAN,
+        std: Optional[List[float]] = IMAGENET_STD
+    ):
+        super().__init__()
+        self.register_buffer(
+            "mean", torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1) * 255.0,
+            persistent=False
+        )
+        self.register_buffer(
+            "inv_std",
+            1.0 / (torch.tensor(std, dtype=torch.float32).view(-1, 1, 1) * 255.0),
+            persistent=False
+        )
+
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.is_floating_point():
+            return (x - self.mean).mul_(self.inv_std)
+        return x.to(torch.float32).sub_(self.mean).mul_(self.inv_std)